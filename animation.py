@@ -0,0 +1,269 @@
+"""
+Morph target and keyframe animation
+
+Several OBJs with the same topology (same materials, vertex counts and
+faces) are loaded as one mesh. The first is the base, and every other one is
+stored as its difference from the base. Each frame the vertices are
+
+  base + weights[0] * delta[0] + weights[1] * delta[1] + ...
+
+which is one matrix-vector product per component, written straight into a
+dynamic mesh's vertices. Keyframes are the same thing with at most two
+weights set, see keyframe_weights.
+
+  morph = MorphMesh(['walk_0.obj', 'walk_1.obj', 'walk_2.obj'])
+  morph.prepare()
+  morph.set_time(t, [0.0, 0.5, 1.0])
+  model.Model(morph.mesh).draw(view)
+"""
+import bisect
+import os
+import threading
+
+import lazy_import
+import material_table
+import mesh
+import obj
+import vertex_format
+
+numpy = lazy_import.module('numpy')
+
+# -----------------------------------------------------------------------------
+#   Weights
+# -----------------------------------------------------------------------------
+
+def keyframe_weights(times, t, loop=True):
+  """
+  Weights that place MorphMesh at time t, given the time of each OBJ (the
+  base first). Between two keyframes they are linearly interpolated. With
+  loop, t wraps around past the last time and the last frame blends back
+  into the first over the same time as the first gap
+  """
+  num_frames = len(times)
+  weights = numpy.zeros(num_frames - 1, dtype=numpy.float32)
+  if num_frames < 2:
+    return weights
+  start, end = times[0], times[-1]
+  if loop:
+    period = end - start + (times[1] - times[0])
+    t = start + (t - start) % period
+  else:
+    t = min(max(t, start), end)
+
+  if t >= end:
+    # Only reachable when looping, between the last frame and the first
+    s = (t - end) / float(times[1] - times[0])
+    weights[-1] = 1.0 - s
+    return weights
+  i = bisect.bisect_right(times, t) - 1
+  s = (t - times[i]) / float(times[i + 1] - times[i])
+  # Frame 0 is the base, so it has no weight of its own
+  if i > 0:
+    weights[i - 1] = 1.0 - s
+  weights[i] = s
+  return weights
+
+# -----------------------------------------------------------------------------
+#   Morph mesh
+# -----------------------------------------------------------------------------
+
+class MorphMesh:
+  def __init__(self, filenames, usage=mesh.Mesh.STREAM, normalize=True,
+               **mesh_options):
+    """
+    filenames are OBJs with matching topology, the base first. mesh_options
+    are passed on to mesh.Mesh. normalize renormalizes blended normals.
+    Positions and texcoords cannot use SNORM16, whose range would only
+    cover the base pose
+    """
+    if usage == mesh.Mesh.STATIC:
+      raise ValueError('Morph meshes need a DYNAMIC or STREAM mesh')
+    self.mesh = obj.read_obj_to_mesh(filenames[0], usage=usage,
+                                     **mesh_options)
+    fmt = self.mesh.vertex_format
+    for attribute in (vertex_format.POSITION, vertex_format.TEXCOORD):
+      if fmt.get_encoding(attribute) == vertex_format.SNORM16:
+        raise ValueError('Morph meshes cannot encode %s as %s' %
+                         (attribute, vertex_format.SNORM16))
+    self.num_targets = len(filenames) - 1
+    self.normalize = normalize
+
+    # Per component, (num_targets + 1, num_vertices * floats_per_vertex): the
+    # base and then the deltas, so blending is a single dot with [1, weights]
+    self.matrices = []
+    # Per component, (floats per vertex, column normals start at or None)
+    self.layouts = []
+    # Per component, (min, max) corners over any weights between 0 and 1
+    self.bounds = []
+
+    targets = [self._read_target(filename) for filename in filenames[1:]]
+    for component_index, component in enumerate(self.mesh.components):
+      base, indices = self.mesh.get_geometry(component_index)
+      name = material_table.table.get_name(component[mesh.Mesh.MATERIAL_ID])
+      signature = component[mesh.Mesh.SIGNATURE]
+      matrix = numpy.empty((self.num_targets + 1, base.size),
+                           dtype=numpy.float32)
+      matrix[0] = base.reshape(-1)
+      for k, (filename, target) in enumerate(zip(filenames[1:], targets)):
+        if name not in target:
+          raise ValueError('%s has no faces with material %s' %
+                           (filename, name))
+        vertices, target_indices, target_signature = target[name]
+        if list(target_signature) != list(signature) or \
+            vertices.shape != base.shape or \
+            not numpy.array_equal(target_indices, indices):
+          raise ValueError('%s does not have the same topology as %s' %
+                           (filename, filenames[0]))
+        matrix[k + 1] = (vertices - base).reshape(-1)
+      self.matrices.append(matrix)
+
+      floats = vertex_format.floats_per_vertex(signature)
+      normal_column = vertex_format.attribute_column(signature,
+                                                     vertex_format.NORMAL)
+      self.layouts.append((floats, normal_column))
+
+      if signature[0] and len(base):
+        deltas = matrix[1:].reshape(self.num_targets, -1, floats)[:, :, :3]
+        lo = base[:, :3] + numpy.minimum(deltas, 0.0).sum(axis=0)
+        hi = base[:, :3] + numpy.maximum(deltas, 0.0).sum(axis=0)
+        self.bounds.append((lo.min(axis=0).tolist(),
+                            hi.max(axis=0).tolist()))
+      else:
+        self.bounds.append(None)
+
+  def _read_target(self, filename):
+    """ Returns {material name: (vertices, indices, signature)} """
+    path, basename = os.path.split(filename)
+    _, vertex_buffers, index_buffers, signature = obj.read_obj(basename,
+                                                               path=path)
+    floats = vertex_format.floats_per_vertex(signature)
+    target = {}
+    for name, vb in vertex_buffers.iteritems():
+      vertices = numpy.array(vb, dtype=numpy.float32).reshape(-1, floats)
+      indices = numpy.array(index_buffers[name], dtype=numpy.uint32)
+      target[name] = (vertices, indices, signature)
+    return target
+
+  def prepare(self, manager=None):
+    self.mesh.prepare(manager)
+    # Covers every pose until the first update, which measures the new one
+    for component, bounds in zip(self.mesh.prepared_components, self.bounds):
+      component[mesh.Mesh.BOUNDS] = bounds
+
+  def new_buffers(self):
+    """ Arrays blend can write into, one per component """
+    return [numpy.empty(matrix.shape[1], dtype=numpy.float32)
+            for matrix in self.matrices]
+
+  def blend(self, weights, out=None):
+    """
+    Computes the vertices for weights (one per target) into out, from
+    new_buffers, and returns it. Makes no GL calls, so it can run on
+    another thread
+    """
+    if len(weights) != self.num_targets:
+      raise ValueError('Expected %d weights, got %d' %
+                       (self.num_targets, len(weights)))
+    if out is None:
+      out = self.new_buffers()
+    coefficients = numpy.empty(self.num_targets + 1, dtype=numpy.float32)
+    coefficients[0] = 1.0
+    coefficients[1:] = weights
+    for matrix, layout, result in zip(self.matrices, self.layouts, out):
+      numpy.dot(coefficients, matrix, out=result)
+      floats, normal_column = layout
+      if self.normalize and normal_column is not None:
+        normals = result.reshape(-1, floats)[:, normal_column:normal_column+3]
+        vertex_format.normalize_rows(normals, out=normals)
+    return out
+
+  def apply(self, blended):
+    """ Uploads arrays from blend on the next draw """
+    for component_index, result in enumerate(blended):
+      self.mesh.update_vertices(result, component_index=component_index)
+
+  def set_weights(self, weights):
+    """ Blends straight into the mesh's own vertices """
+    out = [self.mesh.get_vertices(i).reshape(-1)
+           for i in xrange(len(self.matrices))]
+    self.blend(weights, out)
+    for component_index in xrange(len(self.matrices)):
+      self.mesh.update_vertices(component_index=component_index)
+
+  def set_time(self, t, times, loop=True):
+    self.set_weights(keyframe_weights(times, t, loop))
+
+# -----------------------------------------------------------------------------
+#   Blending in the background
+# -----------------------------------------------------------------------------
+
+class BlendWorker(threading.Thread):
+  """
+  Blends a MorphMesh on another thread. request hands over the weights for
+  an upcoming frame and apply_latest, on the GL thread, uploads the most
+  recent result. NumPy lets go of the GIL during the dot products, so the
+  blending overlaps with drawing. Requests the worker did not get to before
+  a newer one came in are skipped
+  """
+  def __init__(self, morph):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.morph = morph
+    self._condition = threading.Condition()
+    # Weights waiting to be blended, and blended buffers waiting to be applied
+    self._weights = None
+    self._done = None
+    # One being blended, one done and one being applied at most
+    self._spare = [morph.new_buffers() for _ in xrange(3)]
+    self._stopped = False
+    self.error = None
+    self.num_skipped = 0
+
+  def request(self, weights):
+    weights = numpy.array(weights, dtype=numpy.float32)
+    with self._condition:
+      if self._weights is not None:
+        self.num_skipped += 1
+      self._weights = weights
+      self._condition.notify()
+
+  def run(self):
+    while True:
+      with self._condition:
+        while self._weights is None and not self._stopped:
+          self._condition.wait()
+        if self._stopped:
+          return
+        weights = self._weights
+        self._weights = None
+        buffers = self._spare.pop()
+      try:
+        self.morph.blend(weights, buffers)
+      except Exception, e:
+        # Raised from apply_latest on the GL thread
+        self.error = e
+        return
+      with self._condition:
+        if self._done is not None:
+          self._spare.append(self._done)
+        self._done = buffers
+
+  def apply_latest(self):
+    """ Returns True if there was a new result to upload """
+    if self.error is not None:
+      raise self.error
+    with self._condition:
+      buffers = self._done
+      self._done = None
+    if buffers is None:
+      return False
+    self.morph.apply(buffers)
+    with self._condition:
+      self._spare.append(buffers)
+    return True
+
+  def stop(self):
+    with self._condition:
+      self._stopped = True
+      self._condition.notify()
+    self.join()
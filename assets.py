@@ -0,0 +1,125 @@
+"""
+Loads OBJ files once and shares what can be shared
+
+Each file is only read once. Every load hands back a new mesh, but they all
+share the components of the first one, so the file is parsed and uploaded
+once however many meshes use it. Material groups with identical geometry and
+material are also shared between files. Everything is held through weak
+references and goes away with its last user
+"""
+import hashlib
+import weakref
+
+import lazy_import
+import mesh
+import obj
+from file_utils import get_file_key
+
+numpy = lazy_import.module('numpy')
+
+# -----------------------------------------------------------------------------
+#   Hashing
+# -----------------------------------------------------------------------------
+
+def _component_hash(component):
+  """ Content hash of a component's vertices, indices, material and texture """
+  h = hashlib.sha1()
+  vertices = numpy.asarray(component[mesh.Mesh.VERTEX_BUFFER_DATA],
+                           dtype=numpy.float32)
+  indices = numpy.asarray(component[mesh.Mesh.INDEX_BUFFER_DATA],
+                          dtype=numpy.uint32)
+  h.update(vertices.tobytes())
+  h.update(indices.tobytes())
+  h.update(repr(list(component[mesh.Mesh.SIGNATURE])))
+  h.update(repr(sorted(component[mesh.Mesh.MATERIAL].items())))
+  # Same material name can point at different images from different folders
+  texture = component[mesh.Mesh.TEXTURE]
+  if texture is not None:
+    h.update(repr(id(texture)))
+  return h.hexdigest()
+
+def _options_key(mesh_options):
+  return repr(sorted(mesh_options.items()))
+
+# -----------------------------------------------------------------------------
+#   Registry
+# -----------------------------------------------------------------------------
+
+class AssetRegistry:
+  def __init__(self):
+    # Key is (file key, options), value is the Mesh
+    self._meshes = weakref.WeakValueDictionary()
+    # Key is (component hash, options), value is a list of
+    # (weakref to a mesh, component index) for every mesh using it
+    self._components = {}
+
+    self.num_loads = 0
+    self.num_cached = 0
+    self.num_shared_components = 0
+
+  def load_obj(self, filename, **mesh_options):
+    """
+    Same as obj.read_obj_to_mesh, but files and components are shared. The
+    mesh is new and unprepared every time, even when its components have
+    already been uploaded by another one. Dynamic meshes get updated in
+    place, so they are never shared
+    """
+    self.num_loads += 1
+    if mesh_options.get('usage', mesh.Mesh.STATIC) != mesh.Mesh.STATIC:
+      return obj.read_obj_to_mesh(filename, **mesh_options)
+
+    options = _options_key(mesh_options)
+    key = (get_file_key(filename), options)
+    loaded = self._meshes.get(key)
+    if loaded is not None:
+      self.num_cached += 1
+    else:
+      loaded = self._read(filename, options, mesh_options)
+      self._meshes[key] = loaded
+      self._prune()
+
+    m = mesh.Mesh(**mesh_options)
+    for component_index in xrange(len(loaded.components)):
+      m.share_component(loaded, component_index)
+    # Whichever mesh prepares a component first uploads it, from its source
+    m.source = loaded.source
+    # Keeps the loaded mesh, and with it the cache entry, alive while in use
+    m.loaded_from = loaded
+    return m
+
+  def _read(self, filename, options, mesh_options):
+    """ Reads a file, sharing components with files read before """
+    m = obj.read_obj_to_mesh(filename, **mesh_options)
+    for component_index, component in enumerate(m.components):
+      component_key = (_component_hash(component), options)
+      users = self._components.setdefault(component_key, [])
+      for ref, index in users:
+        user = ref()
+        if user is not None:
+          # In place, so indices still line up with the mesh's source
+          m.share_component(user, index, at=component_index)
+          self.num_shared_components += 1
+          break
+      users.append((weakref.ref(m), component_index))
+    return m
+
+  def _prune(self):
+    """ Forgets meshes that have been collected """
+    for component_key, users in self._components.items():
+      users[:] = [(ref, index) for ref, index in users if ref() is not None]
+      if not users:
+        del self._components[component_key]
+
+  def stats(self):
+    return {
+        'loads': self.num_loads,
+        'cached': self.num_cached,
+        'shared_components': self.num_shared_components,
+        'meshes': len(self._meshes),
+        'components': len(self._components),
+      }
+
+registry = AssetRegistry()
+
+def load_obj(filename, **mesh_options):
+  return registry.load_obj(filename, **mesh_options)
@@ -0,0 +1,145 @@
+"""
+Compares the debug and production GL modes
+
+  python benchmark.py [--headless]
+
+Each measurement runs in a fresh interpreter, since the mode has to be picked
+before OpenGL is imported. Import time needs no display. Per-call time opens
+a small window, so it needs one.
+
+--headless times the calls without a window instead. That only measures
+PyOpenGL's Python side, and relies on libGL ignoring calls made without a
+context (libglvnd does), so it is not the default
+"""
+import os
+import subprocess
+import sys
+
+import gl_mode
+
+NUM_IMPORT_RUNS = 20
+NUM_CALLS = 20000
+
+# -----------------------------------------------------------------------------
+#   Measurements, each run in its own process
+# -----------------------------------------------------------------------------
+
+_IMPORT_SCRIPT = """
+import sys, time
+start = time.time()
+import window, obj, model
+elapsed = time.time() - start
+print elapsed, 'numpy' in sys.modules, 'PIL' in sys.modules
+"""
+
+_CALL_SCRIPT = """
+import time
+import window, mesh, model, matrix
+from OpenGL.GL import glFinish
+
+window.create_window('benchmark', 64, 64)
+m = mesh.Mesh()
+# Position, texcoord and normal, so every column of the encoder is used
+m.add_component({}, [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0,
+                     1.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0,
+                     0.0, 1.0, 0.0, 0.0, 1.0, 0.0, 0.0, 1.0],
+                [0, 1, 2], [True, True, True], None)
+m.prepare()
+instance = model.Model(m)
+view = matrix.Matrix()
+
+def time_calls(fcn):
+  glFinish()
+  start = time.time()
+  for _ in xrange(%(num_calls)d):
+    fcn()
+  glFinish()
+  return (time.time() - start) / %(num_calls)d
+
+print time_calls(view.load), time_calls(lambda: instance.draw(view))
+"""
+
+_HEADLESS_SCRIPT = """
+import ctypes, time
+import numpy
+import matrix, mesh, vertex_format
+from OpenGL.GL import GL_ARRAY_BUFFER, GL_TRIANGLES, GL_UNSIGNED_SHORT
+
+view = matrix.Matrix()
+# Position, texcoord and normal, as an OBJ with everything comes out
+vertices = numpy.zeros((3, 8), dtype=numpy.float32)
+vertices[:, 7] = 1.0
+calls = [
+    ('Matrix.load', view.load),
+    ('VertexFormat.encode', lambda: vertex_format.DEFAULT_FORMAT.encode(
+        vertices, [True, True, True])),
+    ('glDrawElements', lambda: mesh.glDrawElements(
+        GL_TRIANGLES, 3, GL_UNSIGNED_SHORT, ctypes.c_void_p(0))),
+    ('glBindBuffer', lambda: mesh.glBindBuffer(GL_ARRAY_BUFFER, 0)),
+    ('glPushMatrix', mesh.glPushMatrix),
+  ]
+for name, fcn in calls:
+  start = time.time()
+  for _ in xrange(%(num_calls)d):
+    fcn()
+  print name, (time.time() - start) / %(num_calls)d
+"""
+
+def _run(mode, script):
+  env = dict(os.environ)
+  env['STUPID_GL_MODE'] = mode
+  here = os.path.dirname(os.path.abspath(__file__))
+  output = subprocess.check_output([sys.executable, '-c', script], env=env,
+                                   cwd=here)
+  return output.split()
+
+def import_time(mode):
+  """ Returns (best seconds, median seconds, numpy imported, PIL imported) """
+  runs = [_run(mode, _IMPORT_SCRIPT) for _ in xrange(NUM_IMPORT_RUNS)]
+  seconds = sorted(float(r[0]) for r in runs)
+  return (seconds[0], seconds[len(seconds) // 2], runs[0][1] == 'True',
+          runs[0][2] == 'True')
+
+def call_time(mode):
+  """ Returns seconds per (Matrix.load, Model.draw) """
+  load, draw = _run(mode, _CALL_SCRIPT % {'num_calls': NUM_CALLS})
+  return float(load), float(draw)
+
+def headless_call_time(mode):
+  """ Returns [(name, seconds per call)] """
+  output = _run(mode, _HEADLESS_SCRIPT % {'num_calls': NUM_CALLS})
+  return [(output[i], float(output[i + 1]))
+          for i in xrange(0, len(output), 2)]
+
+# -----------------------------------------------------------------------------
+#   Report
+# -----------------------------------------------------------------------------
+
+def main(headless=False):
+  print 'Import of window, obj and model (%d runs)' % NUM_IMPORT_RUNS
+  for mode in gl_mode.MODES:
+    best, median, numpy_loaded, pil_loaded = import_time(mode)
+    print '  %-10s best %6.1f ms  median %6.1f ms  numpy loaded: %s  ' \
+        'PIL loaded: %s' % (mode, best * 1000.0, median * 1000.0,
+                            numpy_loaded, pil_loaded)
+
+  if headless:
+    print 'Per call without a window (%d calls)' % NUM_CALLS
+    for mode in gl_mode.MODES:
+      print '  %-10s %s' % (mode, '  '.join(
+          '%s %.2f us' % (name, seconds * 1e6)
+          for name, seconds in headless_call_time(mode)))
+    return
+
+  print 'Per call (%d calls)' % NUM_CALLS
+  for mode in gl_mode.MODES:
+    try:
+      load, draw = call_time(mode)
+    except subprocess.CalledProcessError:
+      print '  %-10s could not open a window' % mode
+      continue
+    print '  %-10s Matrix.load %6.2f us  Model.draw %6.2f us' % (
+        mode, load * 1e6, draw * 1e6)
+
+if __name__ == '__main__':
+  main(headless='--headless' in sys.argv[1:])
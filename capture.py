@@ -0,0 +1,242 @@
+"""
+Records frames without stalling rendering
+
+Each captured frame is read into one of a ring of pixel buffer objects, and
+a fence marks when the copy is done. Later frames check the fences without
+waiting, copy out whatever has finished and queue it for a background thread
+that writes PNGs or raw video. When the GPU or the encoder falls behind,
+frames are dropped instead.
+
+  capture = FrameCapture('out/frame_%05d.png', 800, 600)
+  window.set_capture(capture)
+  ...
+  capture.close()
+
+Raw video is RGBA, top row first, and can be converted with
+  ffmpeg -f rawvideo -pix_fmt rgba -s 800x600 -r 30 -i out.raw out.mp4
+"""
+import ctypes
+import os
+import threading
+import Queue
+
+import gl_mode
+from OpenGL.GL import *
+# The wrapped glReadPixels allocates an array instead of taking a PBO offset
+from OpenGL.raw.GL.VERSION.GL_1_0 import glReadPixels as _read_pixels_raw
+
+import lazy_import
+import resources
+
+numpy = lazy_import.module('numpy')
+
+PNG = 'png'
+RAW = 'raw'
+
+# Seconds close waits on each outstanding fence
+_CLOSE_TIMEOUT = 1.0
+
+# -----------------------------------------------------------------------------
+#   Encoding
+# -----------------------------------------------------------------------------
+
+def _flip(data, width, height):
+  """ GL rows go bottom to top, images go top to bottom """
+  rows = numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, width * 4)
+  return rows[::-1]
+
+class _Encoder(threading.Thread):
+  def __init__(self, output, encoding, width, height, frames):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.output = output
+    self.encoding = encoding
+    self.width = width
+    self.height = height
+    self.frames = frames
+    self.num_encoded = 0
+    self.error = None
+
+  def run(self):
+    video = None
+    try:
+      if self.encoding == RAW:
+        video = open(self.output, 'wb')
+    except Exception, e:
+      self.error = e
+    while True:
+      frame = self.frames.get()
+      if frame is None:
+        break
+      if self.error is not None:
+        # Keep draining, so capture and close never wait on a full queue
+        continue
+      try:
+        self._encode(frame, video)
+      except Exception, e:
+        # Reported by FrameCapture.close, rather than lost on this thread
+        self.error = e
+    if video is not None:
+      video.close()
+
+  def _encode(self, frame, video):
+    frame_number, data = frame
+    pixels = _flip(data, self.width, self.height)
+    if video is not None:
+      video.write(pixels.tobytes())
+    else:
+      from PIL import Image
+      image = Image.frombuffer('RGBA', (self.width, self.height),
+                               pixels.tobytes(), 'raw', 'RGBA', 0, 1)
+      image.save(self.output % frame_number)
+    self.num_encoded += 1
+
+# -----------------------------------------------------------------------------
+#   Capture
+# -----------------------------------------------------------------------------
+
+class FrameCapture:
+  def __init__(self, output, width, height, encoding=None, every=1,
+               ring_size=3, queue_size=8, manager=None):
+    """
+    output is a file name pattern with one %d for PNG, or a file name for raw
+    video. encoding defaults to PNG when output has a %. every=n captures
+    one frame in n. queue_size is how many read frames can wait for the
+    encoder before new ones are dropped
+    """
+    if encoding is None:
+      encoding = PNG if '%' in output else RAW
+    if encoding not in (PNG, RAW):
+      raise ValueError('Unknown capture encoding: %s' % encoding)
+    if every < 1 or ring_size < 1:
+      raise ValueError('every and ring_size must be at least 1')
+    if manager is None:
+      manager = resources.manager
+    directory = os.path.dirname(output)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    self.width = width
+    self.height = height
+    self.every = every
+    self.frame_size = width * height * 4
+    self.frame = 0
+
+    def upload(buffer_id):
+      glBindBuffer(GL_PIXEL_PACK_BUFFER, buffer_id)
+      glBufferData(GL_PIXEL_PACK_BUFFER, self.frame_size, None,
+                   GL_STREAM_READ)
+      glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+    self.buffers = [manager.new_buffer(self.frame_size, upload,
+                                       evictable=False)
+                    for _ in xrange(ring_size)]
+    # Per slot, (frame number, fence) while a read is in flight, else None
+    self.pending = [None] * ring_size
+    self.next_slot = 0
+
+    self.frames = Queue.Queue(queue_size)
+    self.encoder = _Encoder(output, encoding, width, height, self.frames)
+    self.encoder.start()
+
+    self.num_captured = 0
+    # Ring still busy on the GPU
+    self.num_dropped_gpu = 0
+    # Encoder queue full
+    self.num_dropped_encoder = 0
+    self.closed = False
+
+  def capture(self):
+    """
+    Call once a frame, after drawing and before the buffers are swapped
+    """
+    if self.closed:
+      raise ValueError('Capture is closed')
+    frame_number = self.frame
+    self.frame += 1
+    self._collect(wait=False)
+    if frame_number % self.every:
+      return
+
+    slot = self.next_slot
+    if self.pending[slot] is not None:
+      self.num_dropped_gpu += 1
+      return
+    self.next_slot = (slot + 1) % len(self.buffers)
+
+    glBindBuffer(GL_PIXEL_PACK_BUFFER, self.buffers[slot].get_id())
+    _read_pixels_raw(0, 0, self.width, self.height, GL_RGBA,
+                     GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+    glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+    self.pending[slot] = (frame_number, glFenceSync(
+        GL_SYNC_GPU_COMMANDS_COMPLETE, 0))
+
+  def _collect(self, wait):
+    """
+    Copies out every finished read, oldest first. Without wait, stops at the
+    first one the GPU has not finished
+    """
+    num_slots = len(self.buffers)
+    for i in xrange(num_slots):
+      slot = (self.next_slot + i) % num_slots
+      if self.pending[slot] is None:
+        continue
+      frame_number, fence = self.pending[slot]
+      if wait:
+        timeout = int(_CLOSE_TIMEOUT * 1e9)
+        status = glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, timeout)
+      else:
+        status = glClientWaitSync(fence, 0, 0)
+      if status not in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+        if wait:
+          glDeleteSync(fence)
+          self.pending[slot] = None
+          self.num_dropped_gpu += 1
+          continue
+        return
+      glDeleteSync(fence)
+      self.pending[slot] = None
+      self._queue(frame_number, self._read(slot))
+
+  def _read(self, slot):
+    glBindBuffer(GL_PIXEL_PACK_BUFFER, self.buffers[slot].get_id())
+    pointer = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.frame_size,
+                               GL_MAP_READ_BIT)
+    data = ctypes.string_at(pointer, self.frame_size)
+    glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+    glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+    return data
+
+  def _queue(self, frame_number, data):
+    try:
+      self.frames.put_nowait((frame_number, data))
+      self.num_captured += 1
+    except Queue.Full:
+      self.num_dropped_encoder += 1
+
+  def close(self):
+    """
+    Waits for frames still in flight and for the encoder to write everything
+    queued, then frees the buffers. Raises the encoder's error if it had one
+    """
+    if self.closed:
+      return
+    self.closed = True
+    self._collect(wait=True)
+    if self.encoder.is_alive():
+      self.frames.put(None)
+      self.encoder.join()
+    for buffer in self.buffers:
+      buffer.release()
+    self.buffers = []
+    if self.encoder.error is not None:
+      raise self.encoder.error
+
+  def stats(self):
+    return {
+        'frames': self.frame,
+        'captured': self.num_captured,
+        'encoded': self.encoder.num_encoded,
+        'dropped_gpu': self.num_dropped_gpu,
+        'dropped_encoder': self.num_dropped_encoder,
+        'queued': self.frames.qsize(),
+      }
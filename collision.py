@@ -0,0 +1,323 @@
+"""
+Finds models that may be touching
+
+Every model gets a world-space AABB from its mesh's bounds and its
+pos/rot/scale, kept in a uniform grid of cells. update only recomputes the
+models whose transform or mesh changed since the last call, and pairs only
+compares models that share a cell, so the cost grows with the number of
+models rather than the number of pairs.
+
+  world = CollisionWorld(cell_size=5.0)
+  for m in models:
+    world.add(m)
+  ...
+  for a, b in world.pairs():
+    if triangles_intersect(a, b):
+      ...
+"""
+import itertools
+import math
+import weakref
+
+import lazy_import
+import model as model_module
+
+numpy = lazy_import.module('numpy')
+
+# -----------------------------------------------------------------------------
+#   Bodies
+# -----------------------------------------------------------------------------
+
+def _transform_key(m):
+  """ Changes whenever anything that moves the model's AABB changes """
+  return (tuple(m.pos), tuple(m.rot), m.scale, id(m.mesh), m.mesh.version)
+
+def _overlaps(a, b):
+  return (a.lo[0] <= b.hi[0] and b.lo[0] <= a.hi[0] and
+          a.lo[1] <= b.hi[1] and b.lo[1] <= a.hi[1] and
+          a.lo[2] <= b.hi[2] and b.lo[2] <= a.hi[2])
+
+class _Body:
+  def __init__(self, model):
+    self.model = model
+    # None until the first update
+    self.key = None
+    self.lo = None
+    self.hi = None
+    # (first cell, last cell), inclusive, or None when not in the grid
+    self.cells = None
+
+# -----------------------------------------------------------------------------
+#   World
+# -----------------------------------------------------------------------------
+
+class CollisionWorld:
+  def __init__(self, cell_size=10.0, max_cells=64):
+    """
+    cell_size is best around the size of a typical model. Models covering
+    more than max_cells cells are kept out of the grid and checked against
+    everything instead
+    """
+    self.cell_size = float(cell_size)
+    self.max_cells = max_cells
+    # Key is id(model), value is the _Body
+    self._bodies = {}
+    # Key is a cell (i, j, k), value is the set of id(model) in it
+    self._cells = {}
+    # id(model) of models too large for the grid
+    self._large = set()
+
+    self.num_updated = 0
+    self.num_tests = 0
+
+  def add(self, m):
+    """ m is a model.Model whose mesh is prepared """
+    self._bodies[id(m)] = _Body(m)
+
+  def remove(self, m):
+    body = self._bodies.pop(id(m), None)
+    if body is not None:
+      self._unlink(id(m), body)
+
+  def __len__(self):
+    return len(self._bodies)
+
+  def get_aabb(self, m):
+    """ (min, max) corners of the model in world space, or None """
+    self.update()
+    body = self._bodies[id(m)]
+    if body.lo is None:
+      return None
+    return body.lo, body.hi
+
+  # ---------------------------------------------------------------------------
+  #   Updating
+  # ---------------------------------------------------------------------------
+
+  def update(self):
+    """
+    Recomputes the AABBs of models that moved or whose mesh was updated.
+    Returns how many did
+    """
+    changed = []
+    for key, body in self._bodies.iteritems():
+      transform_key = _transform_key(body.model)
+      if transform_key != body.key:
+        body.key = transform_key
+        changed.append((key, body))
+    self.num_updated = len(changed)
+    if not changed:
+      return 0
+
+    moved = []
+    for key, body in changed:
+      bounds = body.model.mesh.get_bounds()
+      if bounds is None:
+        # Nothing to collide with
+        self._unlink(key, body)
+        body.lo = body.hi = None
+      else:
+        moved.append((key, body, bounds))
+    if not moved:
+      return self.num_updated
+
+    # The local box's center and half size through the whole transform at
+    # once. The extent goes through the absolute rotation/scale matrix
+    lo = numpy.array([b[0] for _, _, b in moved], dtype=numpy.float64)
+    hi = numpy.array([b[1] for _, _, b in moved], dtype=numpy.float64)
+    models = [body.model for _, body, _ in moved]
+    matrices = model_module.transform_matrices([m.pos for m in models],
+                                               [m.rot for m in models],
+                                               [m.scale for m in models])
+    rotations = matrices[:, :3, :3]
+    centers = numpy.einsum('nij,nj->ni', rotations, (lo + hi) * 0.5) + \
+        matrices[:, :3, 3]
+    extents = numpy.einsum('nij,nj->ni', numpy.abs(rotations),
+                           (hi - lo) * 0.5)
+    world_lo = (centers - extents).tolist()
+    world_hi = (centers + extents).tolist()
+
+    for (key, body, _), body_lo, body_hi in zip(moved, world_lo, world_hi):
+      body.lo = body_lo
+      body.hi = body_hi
+      self._relink(key, body)
+    return self.num_updated
+
+  def _cell_range(self, body):
+    size = self.cell_size
+    first = tuple(int(math.floor(c / size)) for c in body.lo)
+    last = tuple(int(math.floor(c / size)) for c in body.hi)
+    return first, last
+
+  def _relink(self, key, body):
+    """ Moves a body to the cells its AABB now covers, if they changed """
+    cells = self._cell_range(body)
+    if cells == body.cells:
+      return
+    self._unlink(key, body)
+    first, last = cells
+    count = 1
+    for axis in xrange(3):
+      count *= last[axis] - first[axis] + 1
+    body.cells = cells
+    if count > self.max_cells:
+      self._large.add(key)
+      return
+    for cell in itertools.product(*[xrange(first[axis], last[axis] + 1)
+                                    for axis in xrange(3)]):
+      members = self._cells.get(cell)
+      if members is None:
+        members = self._cells[cell] = set()
+      members.add(key)
+
+  def _unlink(self, key, body):
+    if body.cells is None:
+      return
+    if key in self._large:
+      self._large.discard(key)
+    else:
+      first, last = body.cells
+      for cell in itertools.product(*[xrange(first[axis], last[axis] + 1)
+                                      for axis in xrange(3)]):
+        members = self._cells[cell]
+        members.discard(key)
+        if not members:
+          del self._cells[cell]
+    body.cells = None
+
+  # ---------------------------------------------------------------------------
+  #   Queries
+  # ---------------------------------------------------------------------------
+
+  def pairs(self):
+    """ Returns (model, model) pairs whose AABBs overlap """
+    self.update()
+    bodies = self._bodies
+    seen = set()
+    result = []
+    self.num_tests = 0
+
+    def test(a, b):
+      pair = (a, b) if a < b else (b, a)
+      if pair in seen:
+        return
+      seen.add(pair)
+      self.num_tests += 1
+      if _overlaps(bodies[a], bodies[b]):
+        result.append((bodies[a].model, bodies[b].model))
+
+    for members in self._cells.itervalues():
+      if len(members) > 1:
+        for a, b in itertools.combinations(members, 2):
+          test(a, b)
+    for a in self._large:
+      for b, body in bodies.iteritems():
+        if b != a and body.cells is not None:
+          test(a, b)
+    return result
+
+  def query(self, lo, hi):
+    """ Returns the models whose AABBs overlap the box (lo, hi) """
+    self.update()
+    box = _Body(None)
+    box.lo, box.hi = list(lo), list(hi)
+    first, last = self._cell_range(box)
+    candidates = set(self._large)
+    count = 1
+    for axis in xrange(3):
+      count *= last[axis] - first[axis] + 1
+    if count > len(self._cells):
+      # Cheaper to look at every occupied cell than every covered one
+      for cell, members in self._cells.iteritems():
+        if all(first[axis] <= cell[axis] <= last[axis] for axis in xrange(3)):
+          candidates.update(members)
+    else:
+      for cell in itertools.product(*[xrange(first[axis], last[axis] + 1)
+                                      for axis in xrange(3)]):
+        candidates.update(self._cells.get(cell, ()))
+    return [self._bodies[key].model for key in candidates
+            if _overlaps(self._bodies[key], box)]
+
+# -----------------------------------------------------------------------------
+#   Narrow phase
+# -----------------------------------------------------------------------------
+
+# Key is the mesh, value is its triangles in model space, (n, 3, 3)
+_triangle_cache = weakref.WeakKeyDictionary()
+
+def _local_triangles(mesh):
+  triangles = _triangle_cache.get(mesh)
+  if triangles is None:
+    chunks = []
+    for component_index, component in enumerate(mesh.components):
+      if not component[mesh.SIGNATURE][0]:
+        continue
+      vertices, indices = mesh.get_geometry(component_index)
+      chunks.append(vertices[:, :3][indices.reshape(-1, 3)])
+    if chunks:
+      triangles = numpy.concatenate(chunks).astype(numpy.float64)
+    else:
+      triangles = numpy.zeros((0, 3, 3))
+    # Dynamic meshes change, so only static geometry is kept
+    if mesh.usage == mesh.STATIC:
+      _triangle_cache[mesh] = triangles
+  return triangles
+
+def _world_triangles(m):
+  matrix = model_module.transform_matrices([m.pos], [m.rot], [m.scale])[0]
+  triangles = _local_triangles(m.mesh)
+  return numpy.dot(triangles, matrix[:3, :3].T) + matrix[:3, 3]
+
+def _in_box(triangles, lo, hi):
+  """ Triangles whose own AABB overlaps (lo, hi) """
+  keep = (triangles.min(axis=1) <= hi).all(axis=1) & \
+         (triangles.max(axis=1) >= lo).all(axis=1)
+  return triangles[keep]
+
+def _separated(a, b, axes):
+  """
+  a is (k, 3, 3), b is (m, 3, 3) and axes (k, m, n, 3). Returns (k, m),
+  True where some axis separates the pair
+  """
+  proj_a = numpy.einsum('kmnx,kvx->kmnv', axes, a)
+  proj_b = numpy.einsum('kmnx,mvx->kmnv', axes, b)
+  return ((proj_a.max(axis=3) < proj_b.min(axis=3)) |
+          (proj_b.max(axis=3) < proj_a.min(axis=3))).any(axis=2)
+
+def triangles_intersect(model_a, model_b, max_pairs=20000):
+  """
+  Exact test between two models' triangles with the separating axis test.
+  Only triangles inside both AABBs are compared, max_pairs triangle pairs
+  at a time. Touching or coplanar triangles count as intersecting
+  """
+  a = _world_triangles(model_a)
+  b = _world_triangles(model_b)
+  if not len(a) or not len(b):
+    return False
+  lo = numpy.maximum(a.reshape(-1, 3).min(axis=0), b.reshape(-1, 3).min(axis=0))
+  hi = numpy.minimum(a.reshape(-1, 3).max(axis=0), b.reshape(-1, 3).max(axis=0))
+  if (lo > hi).any():
+    return False
+  a = _in_box(a, lo, hi)
+  b = _in_box(b, lo, hi)
+  if not len(a) or not len(b):
+    return False
+
+  edges_b = numpy.roll(b, -1, axis=1) - b
+  normals_b = numpy.cross(edges_b[:, 0], edges_b[:, 1])
+  chunk = max(max_pairs // len(b), 1)
+  for start in xrange(0, len(a), chunk):
+    part = a[start:start + chunk]
+    edges_a = numpy.roll(part, -1, axis=1) - part
+    normals_a = numpy.cross(edges_a[:, 0], edges_a[:, 1])
+    k, m = len(part), len(b)
+    # Both face normals and the 9 edge cross products, per pair
+    crosses = numpy.cross(edges_a[:, None, :, None, :],
+                          edges_b[None, :, None, :, :]).reshape(k, m, 9, 3)
+    axes = numpy.concatenate([
+        numpy.broadcast_to(normals_a[:, None, None, :], (k, m, 1, 3)),
+        numpy.broadcast_to(normals_b[None, :, None, :], (k, m, 1, 3)),
+        crosses], axis=2)
+    if not _separated(part, b, axes).all():
+      return True
+  return False
@@ -1,5 +1,4 @@
 import os
-from PIL import Image
 
 # -----------------------------------------------------------------------------
 #   File reading
@@ -24,5 +23,12 @@ def get_file_contents(filename, path=''):
 
 def get_image(filename, path=''):
   file_to_open = _get_file_location(filename, path)
+  # PIL is slow to import and only needed once there are textures
+  from PIL import Image
   return Image.open(file_to_open)
 
+def get_file_key(filename, path=''):
+  """ Identifies a file on disk. Changes whenever the file is modified """
+  file_to_open = _get_file_location(filename, path)
+  stat = os.stat(file_to_open)
+  return os.path.abspath(file_to_open), stat.st_mtime, stat.st_size
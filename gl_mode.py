@@ -0,0 +1,93 @@
+"""
+Runtime mode, which has to be picked before PyOpenGL is imported
+
+  import gl_mode
+  gl_mode.set_mode(gl_mode.PRODUCTION)
+  import window
+
+DEBUG keeps PyOpenGL's per-call error checking and logging, and checks
+glGetError every frame. PRODUCTION turns all of that off and swaps the GL
+functions the draw paths call every frame for PyOpenGL's raw entry points.
+The mode can also be set with the STUPID_GL_MODE environment variable
+"""
+import importlib
+import os
+import sys
+
+DEBUG = 'debug'
+PRODUCTION = 'production'
+MODES = (DEBUG, PRODUCTION)
+
+# -----------------------------------------------------------------------------
+#   Mode
+# -----------------------------------------------------------------------------
+
+_mode = None
+
+def set_mode(mode):
+  global _mode
+  if mode not in MODES:
+    raise ValueError('Unknown GL mode: %s' % mode)
+  if mode == _mode:
+    return
+  if 'OpenGL.GL' in sys.modules:
+    raise ValueError('GL mode must be set before OpenGL is imported')
+
+  import OpenGL
+  debug = mode == DEBUG
+  OpenGL.ERROR_CHECKING = debug
+  OpenGL.ERROR_LOGGING = debug
+  OpenGL.FULL_LOGGING = False
+  OpenGL.ARRAY_SIZE_CHECKING = debug
+  _mode = mode
+
+def get_mode():
+  return _mode
+
+def is_production():
+  return _mode == PRODUCTION
+
+# -----------------------------------------------------------------------------
+#   Pre-resolved entry points
+# -----------------------------------------------------------------------------
+
+# Functions called per draw, and the version module of their raw entry point.
+# The raw ones skip PyOpenGL's wrapper, which converts every argument
+_RAW_FUNCTIONS = [
+    ('glMatrixMode', 'GL_1_0'),
+    ('glLoadMatrixd', 'GL_1_0'),
+    ('glMultMatrixd', 'GL_1_0'),
+    ('glPushMatrix', 'GL_1_0'),
+    ('glPopMatrix', 'GL_1_0'),
+    ('glBindTexture', 'GL_1_1'),
+    ('glVertexPointer', 'GL_1_1'),
+    ('glTexCoordPointer', 'GL_1_1'),
+    ('glNormalPointer', 'GL_1_1'),
+    ('glDrawElements', 'GL_1_1'),
+    ('glBindBuffer', 'GL_1_5'),
+    ('glUniform1i', 'GL_2_0'),
+    ('glVertexAttribPointer', 'GL_2_0'),
+    ('glEnableVertexAttribArray', 'GL_2_0'),
+    ('glDisableVertexAttribArray', 'GL_2_0'),
+    ('glDrawElementsInstanced', 'GL_3_1'),
+  ]
+
+def resolve(namespace):
+  """
+  In production, replaces the hot GL functions a module has imported with
+  their raw entry points. Call at the end of the module with globals().
+  Callers have to pass ctypes values (c_void_p offsets, c_double arrays),
+  which the draw paths already do
+  """
+  if _mode != PRODUCTION:
+    return
+  for name, version in _RAW_FUNCTIONS:
+    if name in namespace:
+      module = importlib.import_module('OpenGL.raw.GL.VERSION.' + version)
+      namespace[name] = getattr(module, name)
+
+# Whatever imports this first gets the environment's mode
+if 'OpenGL.GL' in sys.modules:
+  _mode = os.environ.get('STUPID_GL_MODE', DEBUG)
+else:
+  set_mode(os.environ.get('STUPID_GL_MODE', DEBUG))
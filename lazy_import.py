@@ -0,0 +1,24 @@
+"""
+Modules that are only imported once something is looked up on them
+
+  numpy = lazy_import.module('numpy')
+
+keeps numpy out of startup until the first mesh is prepared
+"""
+import importlib
+import sys
+import types
+
+class LazyModule(types.ModuleType):
+  def __getattr__(self, attr):
+    # Only reached while the real module is not loaded. Afterwards every
+    # name is in __dict__ and lookups are as fast as on the module itself
+    module = importlib.import_module(self.__name__)
+    self.__dict__.update(module.__dict__)
+    return getattr(module, attr)
+
+def module(name):
+  """ Returns the module if it is already imported, else a LazyModule """
+  if name in sys.modules:
+    return sys.modules[name]
+  return LazyModule(name)
@@ -0,0 +1,142 @@
+"""
+Compiled materials
+
+MTL files parse into dicts keyed by lowercased property names. The table
+turns each one into a small integer id and keeps the properties in flat
+arrays, so anything that sorts or uploads materials can do it by id
+"""
+from array import array
+
+import gl_mode
+from OpenGL.GL import *
+
+import lazy_import
+
+numpy = lazy_import.module('numpy')
+
+# -----------------------------------------------------------------------------
+#   Material table
+# -----------------------------------------------------------------------------
+
+# MTL keys, lowercased like read_mtllib stores them
+_NS = 'ns'
+_KA = 'ka'
+_KD = 'kd'
+_KS = 'ks'
+_D = 'd'
+_NI = 'ni'
+_ILLUM = 'illum'
+_MAP_KD = 'map_kd'
+
+class MaterialTable(object):
+  __slots__ = ['_ids', 'names', 'specular_exponent', 'ambient', 'diffuse',
+               'specular', 'transparency', 'optical_density', 'illumination',
+               'diffuse_map', '_applied']
+
+  def __init__(self):
+    # Key is (name, frozen values), value is the material id
+    self._ids = {}
+    self.names = []
+    self.specular_exponent = array('f')
+    self.ambient = array('f')  # 3 per material
+    self.diffuse = array('f')  # 3 per material
+    self.specular = array('f')  # 3 per material
+    self.transparency = array('f')
+    self.optical_density = array('f')
+    self.illumination = array('i')
+    self.diffuse_map = []
+    # Id last given to apply, so repeats can be skipped
+    self._applied = None
+
+  def __len__(self):
+    return len(self.names)
+
+  def get_id(self, name, values):
+    """
+    Returns the id for a material dict from read_mtllib, adding it if it is
+    new. Identical materials get the same id, even from different files
+    """
+    key = (name, tuple(sorted(values.items())))
+    material_id = self._ids.get(key)
+    if material_id is not None:
+      return material_id
+
+    material_id = len(self.names)
+    self._ids[key] = material_id
+    self.names.append(name)
+    self.specular_exponent.append(values.get(_NS, 1.0))
+    self.ambient.extend(values.get(_KA, (0.2, 0.2, 0.2)))
+    self.diffuse.extend(values.get(_KD, (0.8, 0.8, 0.8)))
+    self.specular.extend(values.get(_KS, (0.0, 0.0, 0.0)))
+    self.transparency.append(values.get(_D, 1.0))
+    self.optical_density.append(values.get(_NI, 1.0))
+    self.illumination.append(values.get(_ILLUM, 2))
+    self.diffuse_map.append(values.get(_MAP_KD, None))
+    return material_id
+
+  def get_name(self, material_id):
+    return self.names[material_id]
+
+  def get_specular_exponent(self, material_id):
+    return self.specular_exponent[material_id]
+
+  def get_ambient(self, material_id):
+    return tuple(self.ambient[3*material_id:3*material_id+3])
+
+  def get_diffuse(self, material_id):
+    return tuple(self.diffuse[3*material_id:3*material_id+3])
+
+  def get_specular(self, material_id):
+    return tuple(self.specular[3*material_id:3*material_id+3])
+
+  def get_transparency(self, material_id):
+    return self.transparency[material_id]
+
+  def as_arrays(self):
+    """
+    Returns a dict of NumPy arrays indexed by material id, ready to be put
+    in a uniform buffer or texture. They are copies, since the columns are
+    reallocated as materials are added
+    """
+    if not self.names:
+      return {
+          'specular_exponent': numpy.zeros(0, dtype=numpy.float32),
+          'ambient': numpy.zeros((0, 3), dtype=numpy.float32),
+          'diffuse': numpy.zeros((0, 3), dtype=numpy.float32),
+          'specular': numpy.zeros((0, 3), dtype=numpy.float32),
+          'transparency': numpy.zeros(0, dtype=numpy.float32),
+        }
+    n = len(self.names)
+    return {
+        'specular_exponent': numpy.array(self.specular_exponent,
+                                         dtype=numpy.float32),
+        'ambient': numpy.array(self.ambient,
+                               dtype=numpy.float32).reshape(n, 3),
+        'diffuse': numpy.array(self.diffuse,
+                               dtype=numpy.float32).reshape(n, 3),
+        'specular': numpy.array(self.specular,
+                                dtype=numpy.float32).reshape(n, 3),
+        'transparency': numpy.array(self.transparency, dtype=numpy.float32),
+      }
+
+  def apply(self, material_id):
+    """ Sets the fixed-function material, unless it is already set """
+    if material_id == self._applied:
+      return
+    alpha = self.transparency[material_id]
+    glMaterialfv(GL_FRONT_AND_BACK, GL_AMBIENT,
+                 self.get_ambient(material_id) + (alpha,))
+    glMaterialfv(GL_FRONT_AND_BACK, GL_DIFFUSE,
+                 self.get_diffuse(material_id) + (alpha,))
+    glMaterialfv(GL_FRONT_AND_BACK, GL_SPECULAR,
+                 self.get_specular(material_id) + (alpha,))
+    glMaterialf(GL_FRONT_AND_BACK, GL_SHININESS,
+                min(self.specular_exponent[material_id], 128.0))
+    self._applied = material_id
+
+  def reset_applied(self):
+    """ Call when something else has changed the GL material """
+    self._applied = None
+
+# Shared by everything loaded through obj, so ids are the same everywhere
+table = MaterialTable()
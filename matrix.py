@@ -6,8 +6,7 @@ import vec_utils
 
 from ctypes import c_double
 
-from OpenGL.GLUT import *
-from OpenGL.GLU import *
+import gl_mode
 from OpenGL.GL import *
 
 # -----------------------------------------------------------------------------
@@ -35,6 +34,14 @@ class Matrix:
   def load(self):
     glLoadMatrixd(self.to_double())
 
+  def mult(self):
+    glMultMatrixd(self.to_double())
+
+  def to_rows(self):
+    """ Returns the matrix as a row-major list of rows """
+    return [[self.data[_idx(row, col)] for col in range(4)]
+            for row in range(4)]
+
   def get(self, row, col):
     return self.data[_idx(row, col)]
 
@@ -122,14 +129,31 @@ def basis_change_matrix(x_vec, y_vec, z_vec, origin):
 #   Scene
 # -----------------------------------------------------------------------------
 
+def perspective(fov, aspect, near, far):
+  """
+  Returns the same matrix as gluPerspective. fov is in degrees
+  """
+  f = 1.0 / math.tan(math.radians(fov) / 2.0)
+  c = [0.0] * 16
+  c[_idx(0, 0)] = f / aspect
+  c[_idx(1, 1)] = f
+  c[_idx(2, 2)] = (far + near) / (near - far)
+  c[_idx(2, 3)] = (2.0 * far * near) / (near - far)
+  c[_idx(3, 2)] = -1.0
+  return Matrix(c)
+
 def projection_matrix(near=0.1, far=100.0, width=None, height=None):
+  """
+  Loads a perspective projection and returns it, for shaders and culling
+  """
   fov = 45.0
   aspect = 1.0
   if width is not None and height is not None:
     aspect = float(width) / float(height) 
+  p = perspective(fov, aspect, near, far)
   glMatrixMode(GL_PROJECTION)
-  glLoadIdentity()
-  gluPerspective(fov,aspect,near, far)
+  p.load()
+  return p
 
 def view_matrix_raw(eye_x, eye_y, eye_z, 
                     lookat_x, lookat_y, lookat_z, 
@@ -164,5 +188,4 @@ def view_matrix(eye, lookat, up):
 
   return Matrix(c)
 
-
-
+gl_mode.resolve(globals())
@@ -1,14 +1,19 @@
-from ctypes import sizeof, c_float, c_void_p, c_uint
+import sys
+import functools
+import weakref
+from ctypes import c_void_p
 
-from PIL import Image
-
-from OpenGL.GLUT import *
-from OpenGL.GLU import *
+import gl_mode
 from OpenGL.GL import *
 import pickle
-import numpy
 
-from file_utils import get_image
+import lazy_import
+from file_utils import get_image, get_file_key
+import resources
+import vertex_format
+from vertex_format import DEFAULT_FORMAT
+
+numpy = lazy_import.module('numpy')
 
 # -----------------------------------------------------------------------------
 #   Mesh construction
@@ -18,57 +23,108 @@ class Texture:
 
   @classmethod
   def new_from_file(cls, filename, path='', force_new=False):
-    #TODO Cache the texture object
-
+    """
+    Textures are cached while something still uses them, so loading the same
+    image again is free. force_new always reads the file
+    """
     try:
-      image = get_image(filename, path)
-      image_data = list(image.getdata())
-      width, height = image.size
-
-      byte_array = []
-      for pixel in image_data:
-        # Pad to RGBA
-        pixel_rgba = [c for c in pixel]
-        pixel_rgba += [255] * max(0, 4-len(pixel_rgba))
-        for channel in pixel_rgba[:4]:
-          byte_array.append(chr(channel))
-      byte_array = b"".join(byte_array)
-
-      return Texture(width, height, byte_array)
-    except IOError, e:
+      key = get_file_key(filename, path)
+      texture = _texture_cache.get(key)
+      if texture is not None and not force_new:
+        return texture
+
+      width, height, byte_array = _read_pixels(filename, path)
+      texture = Texture(width, height, byte_array, source=(filename, path))
+      _texture_cache[key] = texture
+      return texture
+    except (IOError, OSError), e:
       print "Error loading texture %s : %s" % (filename, str(e))
       return None
 
-  def __init__(self, width, height, byte_array):
+  def __init__(self, width, height, byte_array, source=None):
     self.width = width
     self.height = height
     self.byte_array = byte_array
-    self.texture_id = -1
+    # (filename, path) to read the pixels from again after they are released
+    self.source = source
+    self.resource = None
 
     self.prepared = False
     
-  def prepare(self):
+  def prepare(self, manager=None):
     if self.prepared:
       raise ValueError('Texture is already prepared')
 
-    self.texture_id = glGenTextures(1)
+    if manager is None:
+      manager = resources.manager
+    self.resource = manager.new_texture(self.width * self.height * 4,
+                                        self._upload)
+
+    self.prepared = True
+
+  def _upload(self, texture_id):
+    byte_array = self.byte_array
+    if byte_array is None:
+      _, _, byte_array = _read_pixels(*self.source)
+
     glEnable(GL_TEXTURE_2D)
-    glBindTexture(GL_TEXTURE_2D, self.texture_id)
+    glBindTexture(GL_TEXTURE_2D, texture_id)
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
     glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.width, self.height, 0,
-                 GL_RGBA, GL_UNSIGNED_BYTE, self.byte_array)
+                 GL_RGBA, GL_UNSIGNED_BYTE, byte_array)
 
-    self.prepared = True
+  def release(self):
+    """ Deletes the GL texture. The texture cannot be drawn afterwards """
+    if self.resource is not None:
+      self.resource.release()
+
+  def release_cpu_data(self):
+    """ Drops the pixels once they are in driver memory """
+    if not self.prepared:
+      raise ValueError('Texture is not prepared yet')
+    self.byte_array = None
+    # Without a file to go back to, eviction would lose the texture
+    self.resource.evictable = self.source is not None
+
+  def memory_usage(self):
+    """ Returns (cpu_bytes, estimated_gpu_bytes) """
+    cpu_bytes = 0
+    if self.byte_array is not None:
+      cpu_bytes = sys.getsizeof(self.byte_array)
+    gpu_bytes = 0
+    if self.resource is not None and self.resource.is_resident():
+      gpu_bytes = self.resource.size
+    return cpu_bytes, gpu_bytes
 
   def get_id(self):
-    return self.texture_id
+    return self.resource.get_id()
 
   def bind(self, channel=0):
-    glBindTexture(GL_TEXTURE_2D, self.texture_id)
+    glBindTexture(GL_TEXTURE_2D, self.get_id())
+
+# Key is get_file_key of the image, value is the Texture
+_texture_cache = weakref.WeakValueDictionary()
+
+def _read_pixels(filename, path=''):
+  """ Returns (width, height, byte_array) with the pixels padded to RGBA """
+  image = get_image(filename, path)
+  image_data = list(image.getdata())
+  width, height = image.size
+
+  byte_array = []
+  for pixel in image_data:
+    # Pad to RGBA
+    pixel_rgba = [c for c in pixel]
+    pixel_rgba += [255] * max(0, 4-len(pixel_rgba))
+    for channel in pixel_rgba[:4]:
+      byte_array.append(chr(channel))
+  byte_array = b"".join(byte_array)
+  return width, height, byte_array
 
 class Mesh:
   MATERIAL = 'material'
+  MATERIAL_ID = 'material_id'
   VERTEX_BUFFER_DATA = 'vb_data'
   INDEX_BUFFER_DATA = 'ib_data'
   SIGNATURE = 'signature'
@@ -81,18 +137,69 @@ class Mesh:
   POS_OFFSET = 'pos_offset'
   TEX_OFFSET = 'tex_offset'
   NOR_OFFSET = 'nor_offset'
-
-  def __init__(self):
+  VERTEX_ARRAY = 'vertex_array'
+  RING = 'ring'
+  RING_INDEX = 'ring_index'
+  PENDING = 'pending'
+  INDEX_TYPE = 'index_type'
+  DECODE = 'decode'
+  DECODE_MATRICES = 'decode_matrices'
+  QUANTIZATION_ERROR = 'quantization_error'
+  BOUNDS = 'bounds'
+  BOUNDS_DIRTY = 'bounds_dirty'
+  STAGING = 'staging'
+  PREPARED = 'prepared'
+
+  # Buffer usage. STATIC meshes are uploaded once and frozen. DYNAMIC meshes
+  # have a single buffer that gets range updates. STREAM meshes cycle through
+  # a ring of buffers so the CPU never writes to a buffer the GPU is reading
+  STATIC = 'static'
+  DYNAMIC = 'dynamic'
+  STREAM = 'stream'
+
+  # What happens to the CPU-side vertex/index data after prepare. KEEP leaves
+  # the Python lists alone, COMPACT swaps them for NumPy arrays (enough for
+  # picking and collision) and RELEASE drops them, along with texture pixels
+  KEEP = 'keep'
+  COMPACT = 'compact'
+  RELEASE = 'release'
+
+  def __init__(self, usage=STATIC, ring_size=3, vertex_format=None,
+               cpu_data=KEEP):
+    if usage not in (Mesh.STATIC, Mesh.DYNAMIC, Mesh.STREAM):
+      raise ValueError('Unknown mesh usage: %s' % usage)
+    if cpu_data not in (Mesh.KEEP, Mesh.COMPACT, Mesh.RELEASE):
+      raise ValueError('Unknown cpu data option: %s' % cpu_data)
+    if ring_size < 1:
+      raise ValueError('Ring size must be at least 1, not %s' % ring_size)
     self.components = []
     self.prepared = False
     self.prepared_components = []
-
-  def add_component(self, material, vertex_buffer, index_buffer, signature, texture):
+    self.usage = usage
+    # With a ring size of 1 a STREAM buffer is orphaned and re-specified
+    # instead, which lets the driver hand back fresh memory without a stall
+    self.ring_size = ring_size if usage == Mesh.STREAM else 1
+    if vertex_format is None:
+      vertex_format = DEFAULT_FORMAT
+    self.vertex_format = vertex_format
+    self.cpu_data = cpu_data
+    # Optional function returning [(vertex_buffer, index_buffer)] in the
+    # same order as the components, used to re-upload released geometry
+    self.source = None
+    self.manager = None
+    # Goes up with every update_vertices, so anything worked out from the
+    # geometry can tell when it is stale
+    self.version = 0
+
+  def add_component(self, material, vertex_buffer, index_buffer, signature, texture,
+                    material_id=None):
+    """ material_id is the material's id in material_table, if it has one """
     if self.prepared:
       raise ValueError('Cannot add component after mesh is prepared')
 
     component = {
         Mesh.MATERIAL: material, 
+        Mesh.MATERIAL_ID: material_id,
         Mesh.VERTEX_BUFFER_DATA: vertex_buffer, 
         Mesh.INDEX_BUFFER_DATA: index_buffer,
         Mesh.TEXTURE: texture,
@@ -101,17 +208,37 @@ class Mesh:
 
     self.components.append(component)
 
-  def prepare(self):
+  def share_component(self, other, component_index, at=None):
+    """
+    Adds a component of another mesh without copying it. Once either mesh
+    is prepared, both draw from the same buffers. Both meshes should have
+    been made with the same options, and neither should be dynamic. With
+    at, it replaces this mesh's component at that index instead
+    """
+    if self.prepared:
+      raise ValueError('Cannot add component after mesh is prepared')
+    component = other.components[component_index]
+    if at is None:
+      self.components.append(component)
+    else:
+      self.components[at] = component
+
+  def prepare(self, manager=None):
     """
     After all components have been added, create the vertex/index buffers
     """
     if self.prepared:
       raise ValueError('Mesh is already prepared')
 
-    float_size = sizeof(c_float)
-    for component in self.components:
-      vb_id = glGenBuffers(1)
-      ib_id = glGenBuffers(1)
+    if manager is None:
+      manager = resources.manager
+    self.manager = manager
+    fmt = self.vertex_format
+    for component_index, component in enumerate(self.components):
+      if Mesh.PREPARED in component:
+        # Shared with a mesh that already uploaded it
+        self.prepared_components.append(component[Mesh.PREPARED])
+        continue
 
       vb_data = component[Mesh.VERTEX_BUFFER_DATA]
       ib_data = component[Mesh.INDEX_BUFFER_DATA]
@@ -120,71 +247,466 @@ class Mesh:
       texture = component[Mesh.TEXTURE]
       signature = component[Mesh.SIGNATURE]
 
-      vb_data = (c_float*len(vb_data))(*vb_data)
-      ib_data = (c_uint*len(ib_data))(*ib_data)
-
-      glBindBuffer(GL_ARRAY_BUFFER, vb_id);
-      glBufferData(GL_ARRAY_BUFFER, vb_data, GL_STATIC_DRAW);
-
-      glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ib_id)
-      glBufferData(GL_ELEMENT_ARRAY_BUFFER, ib_data, GL_STATIC_DRAW)
+      offsets, stride = fmt.layout(signature)
+      vertices = numpy.array(vb_data, dtype=numpy.float32)
+      vertices = vertices.reshape(-1, vertex_format.floats_per_vertex(signature))
+      vertex_data, decode, error = fmt.encode(vertices, signature)
+
+      if signature[0] and len(vertices):
+        bounds = (vertices[:, :3].min(axis=0).tolist(),
+                  vertices[:, :3].max(axis=0).tolist())
+      else:
+        bounds = None
+
+      if self.usage == Mesh.STATIC:
+        vertex_array = None
+        gl_usage = GL_STATIC_DRAW
+      else:
+        # Keep a CPU copy so slices can be updated and re-uploaded
+        vertex_array = vertices
+        gl_usage = GL_DYNAMIC_DRAW if self.usage == Mesh.DYNAMIC \
+            else GL_STREAM_DRAW
+
+      # Small meshes get away with 16-bit indices
+      ib_array = numpy.array(ib_data, dtype=numpy.uint32)
+      index_type = GL_UNSIGNED_INT
+      if num_indices and ib_array.max() < 65536:
+        ib_array = ib_array.astype(numpy.uint16)
+        index_type = GL_UNSIGNED_SHORT
+
+      if texture is not None and not texture.prepared:
+        texture.prepare(manager)
+        if self.cpu_data != Mesh.KEEP:
+          texture.release_cpu_data()
+
+      if self.cpu_data == Mesh.COMPACT:
+        component[Mesh.VERTEX_BUFFER_DATA] = vertices
+        component[Mesh.INDEX_BUFFER_DATA] = ib_array
+      elif self.cpu_data == Mesh.RELEASE:
+        component[Mesh.VERTEX_BUFFER_DATA] = None
+        component[Mesh.INDEX_BUFFER_DATA] = None
 
-      stride = 0 * float_size
-      pos_offset = stride
-      stride += (3 * float_size) if signature[0] else 0
-      tex_offset = stride
-      stride += (2 * float_size) if signature[1] else 0
-      nor_offset = stride
-      stride += (3 * float_size) if signature[2] else 0
-
-      if texture is not None:
-        texture.prepare()
       # Store as a prepared component
       prepared_component = {
-          Mesh.VERTEX_BUFFER : vb_id,
-          Mesh.INDEX_BUFFER : ib_id,
           Mesh.NUM_INDICES : num_indices,
+          Mesh.INDEX_TYPE : index_type,
           Mesh.TEXTURE : texture,
+          Mesh.MATERIAL_ID : component[Mesh.MATERIAL_ID],
           Mesh.SIGNATURE : signature,
           Mesh.STRIDE : stride,
-          Mesh.POS_OFFSET : pos_offset,
-          Mesh.TEX_OFFSET : tex_offset,
-          Mesh.NOR_OFFSET : nor_offset,
+          Mesh.POS_OFFSET : offsets[vertex_format.POSITION],
+          Mesh.TEX_OFFSET : offsets[vertex_format.TEXCOORD],
+          Mesh.NOR_OFFSET : offsets[vertex_format.NORMAL],
+          Mesh.DECODE : decode,
+          Mesh.DECODE_MATRICES : dict(
+              (attribute, vertex_format.decode_matrix(*params))
+              for attribute, params in decode.iteritems()),
+          Mesh.QUANTIZATION_ERROR : error,
+          Mesh.BOUNDS : bounds,
+          # Set by update_vertices, bounds are recomputed when next asked for
+          Mesh.BOUNDS_DIRTY : False,
+          Mesh.VERTEX_ARRAY : vertex_array,
+          Mesh.RING_INDEX : 0,
+          # Dirty vertex range (start, end) each ring buffer has not seen yet
+          Mesh.PENDING : [None] * self.ring_size,
+          # Already encoded data for the first upload
+          Mesh.STAGING : (vertex_data, ib_array),
         }
       self.prepared_components.append(prepared_component)
+      component[Mesh.PREPARED] = prepared_component
+
+      # Buffers are owned by the resource manager and may be evicted. They
+      # can only come back if there is something to rebuild them from
+      reloadable = self.cpu_data != Mesh.RELEASE or self.source is not None
+      ring = [manager.new_buffer(vertex_data.nbytes,
+                  functools.partial(self._upload_vertices, component_index,
+                                    slot, gl_usage),
+                  evictable=reloadable or vertex_array is not None)
+              for slot in xrange(self.ring_size)]
+      prepared_component[Mesh.RING] = ring
+      prepared_component[Mesh.VERTEX_BUFFER] = ring[0]
+      prepared_component[Mesh.INDEX_BUFFER] = manager.new_buffer(
+          ib_array.nbytes,
+          functools.partial(self._upload_indices, component_index),
+          evictable=reloadable)
+      del prepared_component[Mesh.STAGING]
     self.prepared = True
 
-  def draw(self):
+  def release(self, textures=True):
     """
-    draw the mesh
+    Deletes the GL buffers and textures. The mesh cannot be drawn afterwards,
+    and neither can any mesh sharing its components or textures
+    """
+    for component in self.prepared_components:
+      for resource in component[Mesh.RING]:
+        resource.release()
+      component[Mesh.INDEX_BUFFER].release()
+    if textures:
+      for texture in self.get_textures():
+        texture.release()
+
+  # ---------------------------------------------------------------------------
+  #   Uploading
+  #     Called by the resource manager, the first time and after evictions
+  # ---------------------------------------------------------------------------
+
+  def _upload_vertices(self, component_index, slot, gl_usage, vb_id):
+    component = self.prepared_components[component_index]
+    if Mesh.STAGING in component:
+      vertex_data = component[Mesh.STAGING][0]
+    else:
+      vertices = component[Mesh.VERTEX_ARRAY]
+      if vertices is None:
+        vertices, _ = self.get_geometry(component_index)
+      vertex_data, _, _ = self.vertex_format.encode(
+          vertices, component[Mesh.SIGNATURE], component[Mesh.DECODE])
+    glBindBuffer(GL_ARRAY_BUFFER, vb_id)
+    glBufferData(GL_ARRAY_BUFFER, vertex_data.nbytes, vertex_data, gl_usage)
+    # Whole buffer is up to date now
+    component[Mesh.PENDING][slot] = None
+
+  def _upload_indices(self, component_index, ib_id):
+    component = self.prepared_components[component_index]
+    if Mesh.STAGING in component:
+      ib_array = component[Mesh.STAGING][1]
+    else:
+      _, ib_array = self.get_geometry(component_index)
+      if component[Mesh.INDEX_TYPE] == GL_UNSIGNED_SHORT:
+        ib_array = ib_array.astype(numpy.uint16)
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ib_id)
+    glBufferData(GL_ELEMENT_ARRAY_BUFFER, ib_array.nbytes, ib_array,
+                 GL_STATIC_DRAW)
+
+  def get_bounds(self):
+    """
+    Returns the (min, max) corners of the AABB around every component, or
+    None if the mesh has no positions. Components changed by update_vertices
+    are measured again
     """
     if not self.prepared:
       raise ValueError('Mesh is not prepared yet')
+    for component in self.prepared_components:
+      if component[Mesh.BOUNDS_DIRTY]:
+        positions = component[Mesh.VERTEX_ARRAY][:, :3]
+        if len(positions):
+          component[Mesh.BOUNDS] = (positions.min(axis=0).tolist(),
+                                    positions.max(axis=0).tolist())
+        component[Mesh.BOUNDS_DIRTY] = False
+    all_bounds = [c[Mesh.BOUNDS] for c in self.prepared_components
+                  if c[Mesh.BOUNDS] is not None]
+    if not all_bounds:
+      return None
+    lo = [min(b[0][i] for b in all_bounds) for i in xrange(3)]
+    hi = [max(b[1][i] for b in all_bounds) for i in xrange(3)]
+    return lo, hi
 
+  def get_geometry(self, component_index=0):
+    """
+    Returns (vertices, indices) for a component as NumPy arrays, vertices
+    being float32 of shape (num_vertices, floats_per_vertex). If the CPU
+    copy was released, it is read again from the mesh's source
+    """
+    component = self.components[component_index]
+    signature = component[Mesh.SIGNATURE]
+    vertices = component[Mesh.VERTEX_BUFFER_DATA]
+    indices = component[Mesh.INDEX_BUFFER_DATA]
+    if self.prepared and self.usage != Mesh.STATIC:
+      # The dynamic copy is the up to date one
+      vertices = self.prepared_components[component_index][Mesh.VERTEX_ARRAY]
+    if vertices is None or indices is None:
+      if self.source is None:
+        raise ValueError('CPU copy of the mesh was released')
+      vertices, indices = self._read_source()[component_index]
+    vertices = numpy.asarray(vertices, dtype=numpy.float32)
+    vertices = vertices.reshape(-1, vertex_format.floats_per_vertex(signature))
+    return vertices, numpy.asarray(indices, dtype=numpy.uint32)
+
+  def _read_source(self):
+    """
+    Calls source at most once a frame. Re-uploading an evicted mesh asks for
+    every component's vertices and indices, and they all share one read
+    """
+    manager = self.manager
+    if manager is None:
+      manager = resources.manager
+    geometry = manager.frame_cache.get(self)
+    if geometry is None:
+      geometry = manager.frame_cache[self] = self.source()
+    return geometry
+
+  def memory_usage(self, seen=None):
+    """
+    Returns (cpu_bytes, estimated_gpu_bytes) for the geometry. Textures are
+    not counted, see memory_report. Components whose id is in seen are
+    skipped (they are shared with a mesh that was already counted), and the
+    ones that get counted are added to it
+    """
+    if seen is None:
+      seen = set()
+    cpu_bytes = 0
+    gpu_bytes = 0
+    for component_index, component in enumerate(self.components):
+      if id(component) in seen:
+        continue
+      seen.add(id(component))
+      for key in [Mesh.VERTEX_BUFFER_DATA, Mesh.INDEX_BUFFER_DATA]:
+        cpu_bytes += _cpu_bytes(component[key])
+      if not self.prepared:
+        continue
+      prepared_component = self.prepared_components[component_index]
+      vertex_array = prepared_component[Mesh.VERTEX_ARRAY]
+      # COMPACT keeps the dynamic copy as the vertex data, don't count it twice
+      if vertex_array is not component[Mesh.VERTEX_BUFFER_DATA]:
+        cpu_bytes += _cpu_bytes(vertex_array)
+      buffers = prepared_component[Mesh.RING] + \
+          [prepared_component[Mesh.INDEX_BUFFER]]
+      gpu_bytes += sum(b.size for b in buffers if b.is_resident())
+    return cpu_bytes, gpu_bytes
+
+  def get_material_ids(self):
+    return [c[Mesh.MATERIAL_ID] for c in self.components]
+
+  def get_textures(self):
+    textures = [c[Mesh.TEXTURE] for c in self.components]
+    return [t for t in textures if t is not None]
+
+  def get_quantization_error(self):
+    """
+    Returns the worst absolute error per attribute over all components,
+    caused by encoding with the mesh's vertex format
+    """
+    if not self.prepared:
+      raise ValueError('Mesh is not prepared yet')
+    worst = {}
     for component in self.prepared_components:
-      vb = component[Mesh.VERTEX_BUFFER]
-      ib = component[Mesh.INDEX_BUFFER]
-      signature = component[Mesh.SIGNATURE]
-      stride = component[Mesh.STRIDE]
-      pos_offset = component[Mesh.POS_OFFSET]
-      tex_offset = component[Mesh.TEX_OFFSET]
-      nor_offset = component[Mesh.NOR_OFFSET]
-      num_indices = component[Mesh.NUM_INDICES]
-      texture = component[Mesh.TEXTURE]
+      for attribute, error in component[Mesh.QUANTIZATION_ERROR].iteritems():
+        worst[attribute] = max(worst.get(attribute, 0.0), error)
+    return worst
+
+  # ---------------------------------------------------------------------------
+  #   Dynamic updates
+  # ---------------------------------------------------------------------------
+
+  def get_vertices(self, component_index=0):
+    """
+    Returns the CPU copy of a dynamic component's vertices, an array of shape
+    (num_vertices, floats_per_vertex). Call update_vertices after writing
+    to it so the change gets uploaded
+    """
+    if not self.prepared:
+      raise ValueError('Mesh is not prepared yet')
+    if self.usage == Mesh.STATIC:
+      raise ValueError('Static meshes do not keep vertices around')
+    return self.prepared_components[component_index][Mesh.VERTEX_ARRAY]
+
+  def update_vertices(self, data=None, first_vertex=0, component_index=0,
+                      num_vertices=None):
+    """
+    Overwrites vertices starting at first_vertex with data, an array of
+    shape (n, floats_per_vertex) or a flat array of floats. If data is None,
+    the range is only marked dirty (for when get_vertices was written to).
+    The upload happens on the next draw, and only covers the changed range
+    """
+    if not self.prepared:
+      raise ValueError('Mesh is not prepared yet')
+    if self.usage == Mesh.STATIC:
+      raise ValueError('Cannot update a static mesh')
+
+    component = self.prepared_components[component_index]
+    vertex_array = component[Mesh.VERTEX_ARRAY]
+    total_vertices, floats_per_vertex = vertex_array.shape
+
+    if data is not None:
+      data = numpy.asarray(data, dtype=numpy.float32)
+      data = data.reshape(-1, floats_per_vertex)
+      num_vertices = len(data)
+    elif num_vertices is None:
+      num_vertices = total_vertices - first_vertex
+    end = first_vertex + num_vertices
+    if first_vertex < 0 or end > total_vertices:
+      raise ValueError('Vertex range %s:%s is outside of 0:%s' %
+                       (first_vertex, end, total_vertices))
+    if data is not None:
+      vertex_array[first_vertex:end] = data
+    if component[Mesh.SIGNATURE][0]:
+      component[Mesh.BOUNDS_DIRTY] = True
+    self.version += 1
+
+    # Every buffer in the ring needs to catch up on this range
+    pending = component[Mesh.PENDING]
+    for i, dirty in enumerate(pending):
+      if dirty is None:
+        pending[i] = (first_vertex, end)
+      else:
+        pending[i] = (min(dirty[0], first_vertex), max(dirty[1], end))
+
+  def _flush_component(self, component):
+    """
+    Moves to the next buffer in the ring and uploads what it has missed
+    """
+    ring = component[Mesh.RING]
+    pending = component[Mesh.PENDING]
+    ring_index = component[Mesh.RING_INDEX]
+    if pending[ring_index] is None:
+      return
+    # The current buffer was just drawn from, so write to the next one
+    if len(ring) > 1:
+      ring_index = (ring_index + 1) % len(ring)
+    component[Mesh.RING_INDEX] = ring_index
+    component[Mesh.VERTEX_BUFFER] = ring[ring_index]
+    # May re-upload everything if it had been evicted
+    vb_id = ring[ring_index].get_id()
+    if pending[ring_index] is None:
+      return
+    vertex_array = component[Mesh.VERTEX_ARRAY]
+    signature = component[Mesh.SIGNATURE]
+    decode = component[Mesh.DECODE]
+    stride = component[Mesh.STRIDE]
+
+    glBindBuffer(GL_ARRAY_BUFFER, vb_id)
+    if self.usage == Mesh.STREAM and len(ring) == 1:
+      # Orphan the old storage and re-specify all of it
+      data, _, _ = self.vertex_format.encode(vertex_array, signature, decode)
+      glBufferData(GL_ARRAY_BUFFER, data.nbytes, None, GL_STREAM_DRAW)
+      glBufferSubData(GL_ARRAY_BUFFER, 0, data.nbytes, data)
+    else:
+      # Encoded against the original ranges so the decode stays valid
+      start, end = pending[ring_index]
+      data, _, _ = self.vertex_format.encode(vertex_array[start:end],
+                                             signature, decode)
+      glBufferSubData(GL_ARRAY_BUFFER, start * stride, data.nbytes, data)
+    pending[ring_index] = None
 
-      glBindBuffer(GL_ARRAY_BUFFER, vb)
-      if signature[0]:
-        glVertexPointer(3, GL_FLOAT, stride, c_void_p(pos_offset));
-      if signature[1]:
-        glTexCoordPointer(2, GL_FLOAT, stride, c_void_p(tex_offset))
-      if signature[2]:
-        glNormalPointer(GL_FLOAT, stride, c_void_p(nor_offset))
-      glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ib)
+  def draw(self):
+    """
+    draw the mesh
+    """
+    if not self.prepared:
+      raise ValueError('Mesh is not prepared yet')
 
-      if texture is not None:
-        texture.bind()
+    for component in self.prepared_components:
+      self.bind_component(component)
+      self.draw_component(component)
 
-      offset = 0
+  def bind_component(self, component, normal_attribute=None):
+    """
+    Binds a prepared component's buffers, pointers and texture. Several
+    draw_component calls can follow. normal_attribute is the location of a
+    shader attribute for normals the fixed-function pipeline cannot read
+    """
+    if self.usage != Mesh.STATIC:
+      self._flush_component(component)
+    vb = component[Mesh.VERTEX_BUFFER].get_id()
+    ib = component[Mesh.INDEX_BUFFER].get_id()
+    signature = component[Mesh.SIGNATURE]
+    stride = component[Mesh.STRIDE]
+    pos_offset = component[Mesh.POS_OFFSET]
+    tex_offset = component[Mesh.TEX_OFFSET]
+    nor_offset = component[Mesh.NOR_OFFSET]
+    texture = component[Mesh.TEXTURE]
+
+    fmt = self.vertex_format
+    glBindBuffer(GL_ARRAY_BUFFER, vb)
+    if signature[0]:
+      glVertexPointer(3, fmt.get_gl_type(vertex_format.POSITION), stride,
+                      c_void_p(pos_offset));
+    if signature[1]:
+      glTexCoordPointer(2, fmt.get_gl_type(vertex_format.TEXCOORD), stride,
+                        c_void_p(tex_offset))
+    if signature[2]:
+      # None for encodings only a shader can unpack
+      nor_type = fmt.get_gl_type(vertex_format.NORMAL)
+      if nor_type is not None:
+        glNormalPointer(nor_type, stride, c_void_p(nor_offset))
+      elif normal_attribute is not None:
+        glVertexAttribPointer(normal_attribute, 2, GL_SHORT, GL_TRUE, stride,
+                              c_void_p(nor_offset))
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ib)
+
+    if texture is not None:
+      texture.bind()
+
+  def draw_component(self, component, instances=None):
+    """
+    Draws a component bound with bind_component. With instances, it is drawn
+    that many times in one call
+    """
+    num_indices = component[Mesh.NUM_INDICES]
+    index_type = component[Mesh.INDEX_TYPE]
+    decode_matrices = component[Mesh.DECODE_MATRICES]
+
+    # Scale int16 positions/texcoords back into their original range
+    pos_decode = decode_matrices.get(vertex_format.POSITION)
+    tex_decode = decode_matrices.get(vertex_format.TEXCOORD)
+    if pos_decode is not None:
+      glPushMatrix()
+      pos_decode.mult()
+    if tex_decode is not None:
+      glMatrixMode(GL_TEXTURE)
+      glPushMatrix()
+      tex_decode.mult()
+      glMatrixMode(GL_MODELVIEW)
+
+    offset = 0
+    if instances is None:
       glDrawElements(GL_TRIANGLES,
-                     num_indices, GL_UNSIGNED_INT,
+                     num_indices, index_type,
                      c_void_p(offset))
+    else:
+      glDrawElementsInstanced(GL_TRIANGLES,
+                              num_indices, index_type,
+                              c_void_p(offset), instances)
+
+    if tex_decode is not None:
+      glMatrixMode(GL_TEXTURE)
+      glPopMatrix()
+      glMatrixMode(GL_MODELVIEW)
+    if pos_decode is not None:
+      glPopMatrix()
+
+# -----------------------------------------------------------------------------
+#   Memory accounting
+# -----------------------------------------------------------------------------
+
+def _cpu_bytes(data):
+  """ Estimates memory held by a list of numbers or a NumPy array """
+  if data is None:
+    return 0
+  if isinstance(data, numpy.ndarray):
+    return data.nbytes
+  # Every element of a list is its own boxed object. Assume they are all the
+  # size of the first one rather than walking the whole list
+  size = sys.getsizeof(data)
+  if len(data):
+    size += len(data) * sys.getsizeof(data[0])
+  return size
+
+def memory_report(meshes):
+  """
+  Adds up memory over a set of meshes and the textures they use. Returns a
+  dict with 'meshes' and 'textures' (lists of (object, cpu_bytes, gpu_bytes))
+  and 'total' ((cpu_bytes, gpu_bytes)). Shared textures and components are
+  counted once, against the first mesh that uses them
+  """
+  report = {'meshes': [], 'textures': []}
+  cpu_total, gpu_total = 0, 0
+  seen_textures = set()
+  seen_components = set()
+  for m in meshes:
+    cpu_bytes, gpu_bytes = m.memory_usage(seen_components)
+    report['meshes'].append((m, cpu_bytes, gpu_bytes))
+    cpu_total += cpu_bytes
+    gpu_total += gpu_bytes
+    for texture in m.get_textures():
+      if id(texture) in seen_textures:
+        continue
+      seen_textures.add(id(texture))
+      cpu_bytes, gpu_bytes = texture.memory_usage()
+      report['textures'].append((texture, cpu_bytes, gpu_bytes))
+      cpu_total += cpu_bytes
+      gpu_total += gpu_bytes
+  report['total'] = (cpu_total, gpu_total)
+  return report
+
+# Must come after everything above that imports GL names
+gl_mode.resolve(globals())
@@ -3,11 +3,13 @@ Wraps an instance of a mesh and its current position
 """
 import mesh
 import matrix
+import lazy_import
 
-from OpenGL.GLUT import *
-from OpenGL.GLU import *
+import gl_mode
 from OpenGL.GL import *
 
+numpy = lazy_import.module('numpy')
+
 # -----------------------------------------------------------------------------
 #   Model class
 # -----------------------------------------------------------------------------
@@ -59,4 +61,33 @@ class Model:
 
     self.mesh.draw()
 
+# -----------------------------------------------------------------------------
+#   Many models at once
+# -----------------------------------------------------------------------------
+
+def transform_matrices(pos, rot, scale):
+  """
+  Same as Model.get_transform_matrix for N models at once. pos and rot are
+  (N, 3) arrays, scale is (N,). Returns row-major matrices of shape (N, 4, 4)
+  """
+  pos = numpy.asarray(pos, dtype=numpy.float64).reshape(-1, 3)
+  rot = numpy.asarray(rot, dtype=numpy.float64).reshape(-1, 3)
+  scale = numpy.asarray(scale, dtype=numpy.float64).reshape(-1)
+  cx, cy, cz = numpy.cos(rot[:, 0]), numpy.cos(rot[:, 1]), numpy.cos(rot[:, 2])
+  sx, sy, sz = numpy.sin(rot[:, 0]), numpy.sin(rot[:, 1]), numpy.sin(rot[:, 2])
 
+  # translate * rotate_y * rotate_x * rotate_z * scale, written out
+  m = numpy.zeros((len(pos), 4, 4))
+  m[:, 0, 0] = cy * cz + sy * sx * sz
+  m[:, 0, 1] = -cy * sz + sy * sx * cz
+  m[:, 0, 2] = sy * cx
+  m[:, 1, 0] = cx * sz
+  m[:, 1, 1] = cx * cz
+  m[:, 1, 2] = -sx
+  m[:, 2, 0] = -sy * cz + cy * sx * sz
+  m[:, 2, 1] = sy * sz + cy * sx * cz
+  m[:, 2, 2] = cy * cx
+  m[:, :3, :3] *= scale[:, None, None]
+  m[:, :3, 3] = pos
+  m[:, 3, 3] = 1.0
+  return m
@@ -1,9 +1,10 @@
 import os
 import mesh
 from collections import defaultdict
-from file_utils import get_file_contents
+from file_utils import get_file_contents, get_file_key
 
 import vec_utils
+import material_table
 
 # -----------------------------------------------------------------------------
 #   MTL reading
@@ -21,9 +22,26 @@ class Material:
     self.values = value_map
 
   def get_specular_exponent(self):
-    return self.values.get(SPECULAR_EXPONENT, 1.0)
+    # read_mtllib lowercases the keys
+    return self.values.get(Material.SPECULAR_EXPONENT.lower(), 1.0)
+
+# Key is the absolute path, value is (file key, materials)
+_mtllib_cache = {}
 
 def read_mtllib(filename, path=''):
+  """
+  Parsed files are cached until they change on disk. The returned dict is
+  shared, so do not modify it
+  """
+  file_key = get_file_key(filename, path)
+  cached = _mtllib_cache.get(file_key[0])
+  if cached is not None and cached[0] == file_key:
+    return cached[1]
+  materials = _parse_mtllib(filename, path)
+  _mtllib_cache[file_key[0]] = (file_key, materials)
+  return materials
+
+def _parse_mtllib(filename, path=''):
   file_contents = get_file_contents(filename, path)
 
   # Materials. Key is material name. Value is dict of the material
@@ -200,20 +218,33 @@ def read_obj(filename, path=''):
 #   Mesh construction
 # -----------------------------------------------------------------------------
 
-def read_obj_to_mesh(filename):
+def read_obj_to_mesh(filename, **mesh_options):
+  """
+  mesh_options are passed on to mesh.Mesh (usage, vertex_format, ...)
+  """
   path, basename = os.path.split(filename)
   materials, vertex_buffers, index_buffers, signature = read_obj(basename, path=path)
 
-  m = mesh.Mesh()
+  m = mesh.Mesh(**mesh_options)
+  material_order = []
   for material, vb in vertex_buffers.iteritems():
+    material_order.append(material)
     ib = index_buffers[material]
+    material_id = material_table.table.get_id(material, materials[material])
     material = materials[material]
     texture_filename = material.get('map_Kd'.lower(), None)
     if texture_filename is not None:
       texture = mesh.Texture.new_from_file(texture_filename, path=path)
     else:
       texture = None
-    m.add_component(material, vb, ib, signature, texture)
+    m.add_component(material, vb, ib, signature, texture, material_id)
+
+  # Lets the mesh get its geometry back if it was released and then evicted
+  def source():
+    _, vertex_buffers, index_buffers, _ = read_obj(basename, path=path)
+    return [(vertex_buffers[material], index_buffers[material])
+            for material in material_order]
+  m.source = source
 
   return m
 
@@ -0,0 +1,258 @@
+"""
+Software occlusion culling
+
+A few models are marked as occluders (walls, big props). Every frame their
+triangles are rasterized on the CPU into a small depth buffer, which is
+reduced into min/max depth pyramids. Each model's bounding box is then
+projected to a screen rectangle and checked against the pyramid level where
+that rectangle covers only a couple of texels. Models entirely behind the
+occluders are culled before they are drawn. No GL calls are made, so this
+also works without a window.
+
+Depths are NDC z, from -1 (near) to 1 (far). Pixels no occluder covers are
+infinitely far away
+"""
+import math
+import time
+
+import lazy_import
+import model as model_module
+
+numpy = lazy_import.module('numpy')
+
+# -----------------------------------------------------------------------------
+#   Helpers
+# -----------------------------------------------------------------------------
+
+# Corners of the unit cube, used to expand (min, max) bounds into 8 points
+_CORNERS = [[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)]
+
+def _to_array(m):
+  return numpy.array(m.to_rows(), dtype=numpy.float64)
+
+def _model_matrices(models):
+  return model_module.transform_matrices([m.pos for m in models],
+                                         [m.rot for m in models],
+                                         [m.scale for m in models])
+
+def occluder_triangles(mesh, max_triangles=256):
+  """
+  Simplifies a mesh into at most max_triangles of its largest triangles,
+  as an array of shape (n, 3, 3). Dropping triangles only ever makes an
+  occluder cover less, so culling stays conservative
+  """
+  triangles = []
+  for component_index, component in enumerate(mesh.components):
+    if not component[mesh.SIGNATURE][0]:
+      continue
+    vertices, indices = mesh.get_geometry(component_index)
+    positions = vertices[:, :3].astype(numpy.float64)
+    triangles.append(positions[indices.reshape(-1, 3)])
+  if not triangles:
+    return numpy.zeros((0, 3, 3))
+  triangles = numpy.concatenate(triangles)
+  if len(triangles) > max_triangles:
+    edges_a = triangles[:, 1] - triangles[:, 0]
+    edges_b = triangles[:, 2] - triangles[:, 0]
+    crosses = numpy.cross(edges_a, edges_b)
+    areas = (crosses * crosses).sum(axis=1)
+    largest = numpy.argsort(areas)[::-1][:max_triangles]
+    triangles = triangles[largest]
+  return triangles
+
+def _reduce(level, op):
+  """ Halves a depth level, each texel becoming op of a 2x2 block """
+  height, width = level.shape
+  padded = numpy.full((height + height % 2, width + width % 2), numpy.inf)
+  padded[:height, :width] = level
+  blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+  return op(op(blocks, axis=3), axis=1)
+
+# -----------------------------------------------------------------------------
+#   Culler
+# -----------------------------------------------------------------------------
+
+class OcclusionCuller:
+  def __init__(self, width=128, height=64, near_w=1e-5):
+    self.width = width
+    self.height = height
+    # Anything closer than this in clip w is treated as crossing the camera
+    self.near_w = near_w
+
+    # List of (model, local triangles)
+    self.occluders = []
+    self.depth = numpy.full((height, width), numpy.inf)
+    # Level 0 is the full depth buffer, each level after is half the size
+    self.max_pyramid = [self.depth]
+    self.min_pyramid = [self.depth]
+    self.view_projection = numpy.identity(4)
+
+    self.stats = {
+        'occluder_triangles': 0,
+        'tested': 0,
+        'occluded': 0,
+        'raster_seconds': 0.0,
+        'test_seconds': 0.0,
+      }
+
+  def add_occluder(self, m, max_triangles=256):
+    """ m is a model.Model whose mesh has CPU geometry or a source """
+    self.occluders.append((m, occluder_triangles(m.mesh, max_triangles)))
+
+  def remove_occluder(self, m):
+    self.occluders = [(o, t) for (o, t) in self.occluders if o is not m]
+
+  # ---------------------------------------------------------------------------
+  #   Rasterizing
+  # ---------------------------------------------------------------------------
+
+  def begin_frame(self, projection, view):
+    """
+    Rasterizes the occluders from this camera. projection and view are
+    matrix.Matrix, e.g. from matrix.perspective and matrix.view_matrix
+    """
+    start = time.time()
+    self.view_projection = numpy.dot(_to_array(projection), _to_array(view))
+    self.depth = numpy.full((self.height, self.width), numpy.inf)
+    self.stats['tested'] = 0
+    self.stats['occluded'] = 0
+    self.stats['test_seconds'] = 0.0
+
+    num_triangles = 0
+    if self.occluders:
+      matrices = _model_matrices([o for o, _ in self.occluders])
+      for (o, triangles), world in zip(self.occluders, matrices):
+        if len(triangles) == 0:
+          continue
+        transform = numpy.dot(self.view_projection, world)
+        points = triangles.reshape(-1, 3)
+        clip = numpy.dot(points, transform[:3, :3].T) + transform[:3, 3]
+        w = numpy.dot(points, transform[3, :3]) + transform[3, 3]
+        self._rasterize(clip.reshape(-1, 3, 3), w.reshape(-1, 3))
+        num_triangles += len(triangles)
+
+    self._build_pyramids()
+    self.stats['occluder_triangles'] = num_triangles
+    self.stats['raster_seconds'] = time.time() - start
+
+  def _rasterize(self, clip, w):
+    # Triangles touching the camera plane are skipped rather than clipped
+    in_front = (w > self.near_w).all(axis=1)
+    clip, w = clip[in_front], w[in_front]
+    ndc = clip / w[:, :, None]
+    xs = (ndc[:, :, 0] * 0.5 + 0.5) * self.width
+    ys = (ndc[:, :, 1] * 0.5 + 0.5) * self.height
+    zs = ndc[:, :, 2]
+
+    # Skip anything outside the screen or the depth range
+    visible = (xs.max(axis=1) >= 0) & (xs.min(axis=1) < self.width) & \
+              (ys.max(axis=1) >= 0) & (ys.min(axis=1) < self.height) & \
+              (zs.min(axis=1) <= 1.0) & (zs.max(axis=1) >= -1.0)
+    depth = self.depth
+    for t in numpy.nonzero(visible)[0]:
+      x0, x1, x2 = xs[t]
+      y0, y1, y2 = ys[t]
+      area = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+      if area == 0.0:
+        continue
+      # Bounding box of pixel centers
+      left = max(int(math.floor(min(x0, x1, x2))), 0)
+      right = min(int(math.ceil(max(x0, x1, x2))), self.width)
+      bottom = max(int(math.floor(min(y0, y1, y2))), 0)
+      top = min(int(math.ceil(max(y0, y1, y2))), self.height)
+      if left >= right or bottom >= top:
+        continue
+      px = numpy.arange(left, right) + 0.5
+      py = (numpy.arange(bottom, top) + 0.5)[:, None]
+
+      # Barycentric weights from the edge functions, either winding
+      w0 = ((x1 - px) * (y2 - py) - (x2 - px) * (y1 - py)) / area
+      w1 = ((x2 - px) * (y0 - py) - (x0 - px) * (y2 - py)) / area
+      w2 = 1.0 - w0 - w1
+      inside = (w0 >= 0) & (w1 >= 0) & (w2 >= 0)
+      if not inside.any():
+        continue
+      z = w0 * zs[t, 0] + w1 * zs[t, 1] + w2 * zs[t, 2]
+      region = depth[bottom:top, left:right]
+      numpy.minimum(region, numpy.where(inside, z, numpy.inf), out=region)
+
+  def _build_pyramids(self):
+    self.max_pyramid = [self.depth]
+    self.min_pyramid = [self.depth]
+    while self.max_pyramid[-1].shape != (1, 1):
+      self.max_pyramid.append(_reduce(self.max_pyramid[-1], numpy.max))
+      self.min_pyramid.append(_reduce(self.min_pyramid[-1], numpy.min))
+
+  # ---------------------------------------------------------------------------
+  #   Testing
+  # ---------------------------------------------------------------------------
+
+  def cull(self, models):
+    """
+    Returns the models that may be visible, in the same order. Call after
+    begin_frame. Models without bounds are always kept
+    """
+    start = time.time()
+    visible = []
+    testable = []
+    for m in models:
+      bounds = m.mesh.get_bounds() if m.mesh.prepared else None
+      if bounds is None:
+        visible.append((m, True))
+      else:
+        testable.append((m, bounds))
+        visible.append((m, None))
+
+    if testable:
+      lo = numpy.array([b[0] for _, b in testable], dtype=numpy.float64)
+      hi = numpy.array([b[1] for _, b in testable], dtype=numpy.float64)
+      # (N, 8, 3) corners in model space
+      unit = numpy.array(_CORNERS, dtype=numpy.float64)
+      corners = lo[:, None, :] + unit[None, :, :] * (hi - lo)[:, None, :]
+      world = _model_matrices([m for m, _ in testable])
+      transforms = numpy.einsum('ij,njk->nik', self.view_projection, world)
+      clip = numpy.einsum('nij,nkj->nki', transforms[:, :, :3], corners) + \
+          transforms[:, None, :, 3]
+      results = iter([self._test_box(c) for c in clip])
+      visible = [(m, result if result is not None else next(results))
+                 for m, result in visible]
+
+    kept = [m for m, is_visible in visible if is_visible]
+    self.stats['tested'] += len(testable)
+    self.stats['occluded'] += len(models) - len(kept)
+    self.stats['test_seconds'] += time.time() - start
+    return kept
+
+  def is_visible(self, m):
+    return len(self.cull([m])) == 1
+
+  def _test_box(self, clip):
+    """ clip is the (8, 4) clip space corners of one bounding box """
+    w = clip[:, 3]
+    if (w <= self.near_w).any():
+      # Crosses the camera plane, so it covers the screen
+      return True
+    ndc = clip[:, :3] / w[:, None]
+    nearest = ndc[:, 2].min()
+    x0 = (ndc[:, 0].min() * 0.5 + 0.5) * self.width
+    x1 = (ndc[:, 0].max() * 0.5 + 0.5) * self.width
+    y0 = (ndc[:, 1].min() * 0.5 + 0.5) * self.height
+    y1 = (ndc[:, 1].max() * 0.5 + 0.5) * self.height
+    left, right = max(int(x0), 0), min(int(math.ceil(x1)), self.width)
+    bottom, top = max(int(y0), 0), min(int(math.ceil(y1)), self.height)
+    if left >= right or bottom >= top:
+      # Off screen. Leave that to frustum culling
+      return True
+
+    # Level at which the rectangle spans no more than about 2 texels
+    size = max(right - left, top - bottom)
+    level = max(int(math.ceil(math.log(size, 2))) - 1, 0)
+    level = min(level, len(self.max_pyramid) - 1)
+    shift = 2 ** level
+    texels = numpy.s_[bottom // shift:(top - 1) // shift + 1,
+                      left // shift:(right - 1) // shift + 1]
+
+    # In front of the nearest occluder in the area, no need to look further
+    if ndc[:, 2].max() < self.min_pyramid[level][texels].min():
+      return True
+    return nearest <= self.max_pyramid[level][texels].max()
@@ -0,0 +1,239 @@
+"""
+Programmable alternative to Model.draw
+
+Models are submitted during the frame instead of drawn. At the end of the
+frame every model-view matrix is computed at once, uploaded to a texture
+buffer in a single call, and each mesh is drawn with one instanced call per
+component, the shader fetching its matrix by instance.
+
+  pipeline.begin_frame(projection, view)
+  for m in models:
+    pipeline.submit(m)
+  pipeline.end_frame()
+"""
+import gl_mode
+from OpenGL.GL import *
+
+import lazy_import
+import model
+import resources
+import shader
+import vertex_format
+
+numpy = lazy_import.module('numpy')
+
+# -----------------------------------------------------------------------------
+#   Shaders
+# -----------------------------------------------------------------------------
+
+VERTEX_SOURCE = """
+#version 150 compatibility
+uniform samplerBuffer u_model_views;
+uniform int u_base;
+uniform mat4 u_projection;
+uniform int u_oct_normals;
+in vec2 a_oct_normal;
+out vec2 v_texcoord;
+out vec3 v_normal;
+
+mat4 fetch_model_view(int index) {
+  // One column per texel
+  return mat4(texelFetch(u_model_views, index * 4),
+              texelFetch(u_model_views, index * 4 + 1),
+              texelFetch(u_model_views, index * 4 + 2),
+              texelFetch(u_model_views, index * 4 + 3));
+}
+
+vec3 decode_octahedral(vec2 e) {
+  vec3 n = vec3(e, 1.0 - abs(e.x) - abs(e.y));
+  if (n.z < 0.0) {
+    n.xy = (1.0 - abs(n.yx)) * vec2(n.x >= 0.0 ? 1.0 : -1.0,
+                                    n.y >= 0.0 ? 1.0 : -1.0);
+  }
+  return normalize(n);
+}
+
+void main() {
+  mat4 model_view = fetch_model_view(u_base + gl_InstanceID);
+  // The fixed-function matrices only hold the mesh's quantization decode
+  gl_Position = u_projection * model_view * gl_ModelViewMatrix * gl_Vertex;
+  v_texcoord = (gl_TextureMatrix[0] * gl_MultiTexCoord0).xy;
+  vec3 normal = u_oct_normals != 0 ? decode_octahedral(a_oct_normal)
+                                   : gl_Normal;
+  v_normal = mat3(model_view) * normal;
+}
+"""
+
+FRAGMENT_SOURCE = """
+#version 150 compatibility
+uniform sampler2D u_texture;
+uniform int u_textured;
+// Directional light in view space, pointing towards the light
+uniform vec3 u_light_direction;
+uniform int u_lit;
+in vec2 v_texcoord;
+in vec3 v_normal;
+
+void main() {
+  vec4 color = u_textured != 0 ? texture(u_texture, v_texcoord) : vec4(1.0);
+  if (u_lit != 0) {
+    float diffuse = max(dot(normalize(v_normal), u_light_direction), 0.0);
+    color.rgb *= 0.25 + 0.75 * diffuse;
+  }
+  gl_FragColor = color;
+}
+"""
+
+# Texture unit the matrices are bound to. Unit 0 is left for mesh textures
+_MATRIX_UNIT = 1
+
+# -----------------------------------------------------------------------------
+#   Pipeline
+# -----------------------------------------------------------------------------
+
+class ShaderPipeline:
+  def __init__(self, vertex_source=VERTEX_SOURCE,
+               fragment_source=FRAGMENT_SOURCE, shaders=None,
+               manager=None):
+    if shaders is None:
+      shaders = shader.manager
+    if manager is None:
+      manager = resources.manager
+    self.shaders = shaders
+    self.manager = manager
+    self.vertex_source = vertex_source
+    self.fragment_source = fragment_source
+
+    self.projection = None
+    self.view = None
+    # View space, towards the light. Components without normals are unlit
+    self.light_direction = (0.0, 0.0, 1.0)
+    self._models = []
+
+    # Texture buffer holding the frame's matrices, grown as needed
+    self.capacity = 0
+    self.buffer = None
+    self.texture = None
+
+    self.num_draw_calls = 0
+
+  def begin_frame(self, projection, view):
+    """ projection and view are matrix.Matrix """
+    self.projection = projection
+    self.view = view
+    self._models = []
+
+  def submit(self, m):
+    self._models.append(m)
+
+  def end_frame(self):
+    models = self._models
+    self._models = []
+    self.num_draw_calls = 0
+    if not models:
+      return
+
+    # Instances of the same mesh need to sit next to each other
+    models.sort(key=lambda m: id(m.mesh))
+    transforms = model.transform_matrices([m.pos for m in models],
+                                          [m.rot for m in models],
+                                          [m.scale for m in models])
+    view = numpy.array(self.view.to_rows())
+    model_views = numpy.einsum('ij,njk->nik', view, transforms)
+    # Column-major, like glLoadMatrix expects
+    data = numpy.ascontiguousarray(model_views.transpose(0, 2, 1),
+                                   dtype=numpy.float32)
+    self._upload(data)
+
+    program = self.shaders.get_program(self.vertex_source,
+                                       self.fragment_source)
+    program.use()
+    glUniformMatrix4fv(program.uniform('u_projection'), 1, GL_FALSE,
+                       numpy.array(self.projection.data, dtype=numpy.float32))
+    glUniform1i(program.uniform('u_model_views'), _MATRIX_UNIT)
+    glUniform1i(program.uniform('u_texture'), 0)
+    light = numpy.array(self.light_direction, dtype=numpy.float64)
+    light /= numpy.sqrt((light * light).sum()) or 1.0
+    glUniform3f(program.uniform('u_light_direction'), *light.tolist())
+    glActiveTexture(GL_TEXTURE0 + _MATRIX_UNIT)
+    glBindTexture(GL_TEXTURE_BUFFER, self.texture.get_id())
+    glActiveTexture(GL_TEXTURE0)
+
+    # Leaves room for the decode matrices meshes push
+    glMatrixMode(GL_MODELVIEW)
+    glLoadIdentity()
+
+    base_location = program.uniform('u_base')
+    textured_location = program.uniform('u_textured')
+    oct_location = program.uniform('u_oct_normals')
+    lit_location = program.uniform('u_lit')
+    normal_attribute = program.attribute('a_oct_normal')
+
+    start = 0
+    while start < len(models):
+      m = models[start].mesh
+      end = start + 1
+      while end < len(models) and models[end].mesh is m:
+        end += 1
+
+      # Octahedral normals only reach a shader that reads a_oct_normal
+      octahedral = m.vertex_format.get_encoding(vertex_format.NORMAL) == \
+          vertex_format.OCTAHEDRAL
+      oct_normals = octahedral and normal_attribute >= 0
+      glUniform1i(oct_location, int(oct_normals))
+      glUniform1i(base_location, start)
+      for component in m.prepared_components:
+        lit = component[m.SIGNATURE][2] and (oct_normals or not octahedral)
+        glUniform1i(lit_location, int(lit))
+        if lit and oct_normals:
+          glEnableVertexAttribArray(normal_attribute)
+        elif lit:
+          glEnableClientState(GL_NORMAL_ARRAY)
+        m.bind_component(component,
+                         normal_attribute if oct_normals else None)
+        glUniform1i(textured_location,
+                    int(component[m.TEXTURE] is not None))
+        m.draw_component(component, instances=end - start)
+        self.num_draw_calls += 1
+        if lit and oct_normals:
+          glDisableVertexAttribArray(normal_attribute)
+        elif lit:
+          glDisableClientState(GL_NORMAL_ARRAY)
+      start = end
+
+    glUseProgram(0)
+
+  def _upload(self, data):
+    """ Writes the matrices to the texture buffer, orphaning the old ones """
+    if data.nbytes > self.capacity:
+      capacity = max(data.nbytes, self.capacity * 2)
+      self.release()
+
+      def upload_buffer(buffer_id):
+        glBindBuffer(GL_TEXTURE_BUFFER, buffer_id)
+        glBufferData(GL_TEXTURE_BUFFER, capacity, None, GL_STREAM_DRAW)
+      def upload_texture(texture_id):
+        glBindTexture(GL_TEXTURE_BUFFER, texture_id)
+        glTexBuffer(GL_TEXTURE_BUFFER, GL_RGBA32F, self.buffer.get_id())
+
+      self.capacity = capacity
+      self.buffer = self.manager.new_buffer(capacity, upload_buffer,
+                                            evictable=False)
+      # Only a view of the buffer, so it takes no memory of its own
+      self.texture = self.manager.new_texture(0, upload_texture,
+                                              evictable=False)
+
+    glBindBuffer(GL_TEXTURE_BUFFER, self.buffer.get_id())
+    glBufferData(GL_TEXTURE_BUFFER, self.capacity, None, GL_STREAM_DRAW)
+    glBufferSubData(GL_TEXTURE_BUFFER, 0, data.nbytes, data)
+    glBindBuffer(GL_TEXTURE_BUFFER, 0)
+
+  def release(self):
+    if self.texture is not None:
+      self.texture.release()
+      self.buffer.release()
+    self.texture = None
+    self.buffer = None
+    self.capacity = 0
+
+gl_mode.resolve(globals())
@@ -0,0 +1,191 @@
+"""
+Owns every GL buffer and texture handle
+
+Each resource knows its size and how to upload itself. Once the total goes
+over the budget, the resources that have gone unused the longest are deleted,
+and they are uploaded again the next time something asks for their id
+"""
+import weakref
+
+import gl_mode
+from OpenGL.GL import *
+
+# -----------------------------------------------------------------------------
+#   Resource
+# -----------------------------------------------------------------------------
+
+class Resource:
+  BUFFER = 'buffer'
+  TEXTURE = 'texture'
+
+  def __init__(self, manager, kind, size, upload, evictable=True):
+    """
+    upload is called with a freshly generated GL name and has to fill it in.
+    Resources that cannot be uploaded a second time are not evictable
+    """
+    self.manager = manager
+    self.kind = kind
+    self.size = size
+    self.upload = upload
+    self.evictable = evictable
+    self.last_used = -1
+    # Shared with the manager, so the name can still be freed after this
+    # object is garbage collected
+    self.handle = [None]
+
+  def is_resident(self):
+    return self.handle[0] is not None
+
+  def get_id(self):
+    """ Returns the GL name, uploading again first if it was evicted """
+    self.last_used = self.manager.frame
+    if self.handle[0] is None:
+      self.manager._make_resident(self)
+    return self.handle[0]
+
+  def release(self):
+    """ Frees the GL memory for good """
+    self.manager._release(self)
+
+# -----------------------------------------------------------------------------
+#   Manager
+# -----------------------------------------------------------------------------
+
+class ResourceManager:
+  def __init__(self, budget=None):
+    """ budget is in bytes. None means nothing is ever evicted """
+    self.budget = budget
+    self.frame = 0
+    self.resident_bytes = 0
+    self.num_evictions = 0
+    self.num_uploads = 0
+
+    self._next_key = 0
+    # Key is a counter, value is a weakref to the resource
+    self._resources = {}
+    # (kind, name, size) for resources that were collected while resident.
+    # GL calls are not safe from a weakref callback, so they wait for
+    # next_frame
+    self._orphans = []
+    # Key is an object, value is something it worked out during this frame
+    # and can reuse until next_frame empties it
+    self.frame_cache = weakref.WeakKeyDictionary()
+    # Frame in which enforce_budget last ran out of things to evict
+    self._exhausted_frame = None
+
+  def new_buffer(self, size, upload, evictable=True):
+    return self._new(Resource.BUFFER, size, upload, evictable)
+
+  def new_texture(self, size, upload, evictable=True):
+    return self._new(Resource.TEXTURE, size, upload, evictable)
+
+  def set_budget(self, budget):
+    self.budget = budget
+    self.enforce_budget()
+
+  def next_frame(self):
+    """ Call once per frame, after drawing """
+    # Emptied in place, since every weakref callback holds on to this list
+    orphans = self._orphans[:]
+    del self._orphans[:]
+    for kind, name, size in orphans:
+      _delete(kind, name)
+      self.resident_bytes -= size
+    self.frame_cache.clear()
+    self.frame += 1
+    self.enforce_budget()
+
+  def enforce_budget(self):
+    """
+    Evicts least-recently-used resources until under budget. Anything used
+    during the current frame is left alone
+    """
+    if self.budget is None or self.resident_bytes <= self.budget:
+      return
+    if self._exhausted_frame == self.frame:
+      # Everything left was used this frame, and nothing else can become
+      # evictable before next_frame. Scanning again on every upload would
+      # make loading past the budget quadratic
+      return
+    candidates = [r for r in self.get_resources()
+                  if r.is_resident() and r.evictable
+                  and r.last_used < self.frame]
+    candidates.sort(key=lambda r: r.last_used)
+    for resource in candidates:
+      if self.resident_bytes <= self.budget:
+        break
+      self.evict(resource)
+    if self.resident_bytes > self.budget:
+      self._exhausted_frame = self.frame
+
+  def evict(self, resource):
+    name = resource.handle[0]
+    if name is None:
+      return
+    _delete(resource.kind, name)
+    resource.handle[0] = None
+    self.resident_bytes -= resource.size
+    self.num_evictions += 1
+
+  def get_resources(self):
+    resources = [ref() for ref in self._resources.values()]
+    return [r for r in resources if r is not None]
+
+  def stats(self):
+    resources = self.get_resources()
+    return {
+        'frame': self.frame,
+        'budget': self.budget,
+        'resident_bytes': self.resident_bytes,
+        'resources': len(resources),
+        'resident': len([r for r in resources if r.is_resident()]),
+        'uploads': self.num_uploads,
+        'evictions': self.num_evictions,
+      }
+
+  def _new(self, kind, size, upload, evictable):
+    resource = Resource(self, kind, size, upload, evictable)
+    key = self._next_key
+    self._next_key += 1
+
+    handle = resource.handle
+    def collected(ref, resources=self._resources, orphans=self._orphans):
+      del resources[key]
+      if handle[0] is not None:
+        orphans.append((kind, handle[0], size))
+    self._resources[key] = weakref.ref(resource, collected)
+
+    self._make_resident(resource)
+    return resource
+
+  def _make_resident(self, resource):
+    if resource.kind == Resource.BUFFER:
+      name = glGenBuffers(1)
+    else:
+      name = glGenTextures(1)
+    # PyOpenGL can hand back a NumPy integer, which raw entry points reject
+    name = int(name)
+    resource.handle[0] = name
+    resource.upload(name)
+    resource.last_used = self.frame
+    self.resident_bytes += resource.size
+    self.num_uploads += 1
+    self.enforce_budget()
+
+  def _release(self, resource):
+    self.evict(resource)
+    # Never upload again
+    resource.evictable = False
+    resource.upload = _released
+
+def _delete(kind, name):
+  if kind == Resource.BUFFER:
+    glDeleteBuffers(1, [name])
+  else:
+    glDeleteTextures([name])
+
+def _released(name):
+  raise ValueError('Resource has been released')
+
+# Used by meshes and textures unless they are given their own
+manager = ResourceManager()
@@ -0,0 +1,88 @@
+"""
+Compiles GLSL programs and caches them by source
+"""
+import gl_mode
+from OpenGL.GL import *
+
+# -----------------------------------------------------------------------------
+#   Program
+# -----------------------------------------------------------------------------
+
+class Program:
+  def __init__(self, program_id):
+    self.id = program_id
+    # Locations are looked up once. -1 when the name is unused
+    self._uniforms = {}
+    self._attributes = {}
+
+  def use(self):
+    glUseProgram(self.id)
+
+  def uniform(self, name):
+    location = self._uniforms.get(name)
+    if location is None:
+      location = glGetUniformLocation(self.id, name)
+      self._uniforms[name] = location
+    return location
+
+  def attribute(self, name):
+    location = self._attributes.get(name)
+    if location is None:
+      location = glGetAttribLocation(self.id, name)
+      self._attributes[name] = location
+    return location
+
+# -----------------------------------------------------------------------------
+#   Compiling
+# -----------------------------------------------------------------------------
+
+def _compile_shader(shader_type, source):
+  shader_id = glCreateShader(shader_type)
+  glShaderSource(shader_id, source)
+  glCompileShader(shader_id)
+  if not glGetShaderiv(shader_id, GL_COMPILE_STATUS):
+    log = glGetShaderInfoLog(shader_id)
+    glDeleteShader(shader_id)
+    raise ValueError('Shader failed to compile: %s' % log)
+  return shader_id
+
+def _link_program(vertex_source, fragment_source):
+  vertex_shader = _compile_shader(GL_VERTEX_SHADER, vertex_source)
+  fragment_shader = _compile_shader(GL_FRAGMENT_SHADER, fragment_source)
+  program_id = glCreateProgram()
+  glAttachShader(program_id, vertex_shader)
+  glAttachShader(program_id, fragment_shader)
+  glLinkProgram(program_id)
+  # The program keeps what it needs
+  glDeleteShader(vertex_shader)
+  glDeleteShader(fragment_shader)
+  if not glGetProgramiv(program_id, GL_LINK_STATUS):
+    log = glGetProgramInfoLog(program_id)
+    glDeleteProgram(program_id)
+    raise ValueError('Shader program failed to link: %s' % log)
+  return program_id
+
+# -----------------------------------------------------------------------------
+#   Manager
+# -----------------------------------------------------------------------------
+
+class ShaderManager:
+  def __init__(self):
+    # Key is (vertex source, fragment source), value is the Program
+    self._programs = {}
+
+  def get_program(self, vertex_source, fragment_source):
+    """ Compiles the program the first time it is asked for """
+    key = (vertex_source, fragment_source)
+    program = self._programs.get(key)
+    if program is None:
+      program = Program(_link_program(vertex_source, fragment_source))
+      self._programs[key] = program
+    return program
+
+  def release(self):
+    for program in self._programs.itervalues():
+      glDeleteProgram(program.id)
+    self._programs = {}
+
+manager = ShaderManager()
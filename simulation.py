@@ -0,0 +1,203 @@
+"""
+Runs updates on their own thread, at their own rate
+
+The update function moves models on a worker thread at a fixed step. After
+each step the models' transforms are copied into a Snapshot, whose arrays
+are read only, and published. Drawing never waits on the update: it takes
+the last two snapshots and draws in between them, so a slow step makes
+motion lag a little instead of holding up the frame.
+
+  def update(dt):
+    for m in models:
+      m.rotate(0, dt, 0)
+
+  updater = UpdateThread(models, update, rate=60)
+  updater.start()
+  window.set_main_loop(lambda dt: updater.draw(view))
+
+The update function runs under the GIL like any Python code, so it mostly
+helps when it spends its time in NumPy or waiting on I/O
+"""
+import math
+import threading
+import time
+
+import lazy_import
+import matrix
+import model as model_module
+
+import gl_mode
+from OpenGL.GL import *
+
+numpy = lazy_import.module('numpy')
+
+# -----------------------------------------------------------------------------
+#   Snapshots
+# -----------------------------------------------------------------------------
+
+def _read_only(array):
+  array.flags.writeable = False
+  return array
+
+class Snapshot:
+  def __init__(self, step, sim_time, meshes, pos, rot, scale):
+    """ pos and rot are (N, 3), scale is (N,) """
+    self.step = step
+    self.time = sim_time
+    # Wall clock time it was published at
+    self.published = None
+    self.meshes = tuple(meshes)
+    self.pos = _read_only(numpy.asarray(pos, dtype=numpy.float64))
+    self.rot = _read_only(numpy.asarray(rot, dtype=numpy.float64))
+    self.scale = _read_only(numpy.asarray(scale, dtype=numpy.float64))
+
+  @classmethod
+  def capture(cls, step, sim_time, models):
+    return cls(step, sim_time, [m.mesh for m in models],
+               numpy.array([m.pos for m in models],
+                           dtype=numpy.float64).reshape(-1, 3),
+               numpy.array([m.rot for m in models],
+                           dtype=numpy.float64).reshape(-1, 3),
+               [m.scale for m in models])
+
+  def __len__(self):
+    return len(self.meshes)
+
+  def same_models(self, other):
+    return len(self.meshes) == len(other.meshes) and \
+        all(a is b for a, b in zip(self.meshes, other.meshes))
+
+  def interpolate(self, other, alpha):
+    """
+    Snapshot alpha of the way from this one to other. Rotations take the
+    short way around
+    """
+    turn = 2.0 * math.pi
+    rot_delta = (other.rot - self.rot + math.pi) % turn - math.pi
+    return Snapshot(other.step, self.time + (other.time - self.time) * alpha,
+                    other.meshes,
+                    self.pos + (other.pos - self.pos) * alpha,
+                    self.rot + rot_delta * alpha,
+                    self.scale + (other.scale - self.scale) * alpha)
+
+  def transform_matrices(self):
+    return model_module.transform_matrices(self.pos, self.rot, self.scale)
+
+  def draw(self, view_matrix):
+    """ Same as Model.draw on every model, with all matrices made at once """
+    view = numpy.array(view_matrix.to_rows())
+    model_views = numpy.einsum('ij,njk->nik', view, self.transform_matrices())
+    # Column-major, like Matrix.data
+    columns = model_views.transpose(0, 2, 1).reshape(-1, 16).tolist()
+    glMatrixMode(GL_MODELVIEW)
+    for m, data in zip(self.meshes, columns):
+      matrix.Matrix(data).load()
+      m.draw()
+
+class SnapshotBuffer:
+  """
+  Holds the last two published snapshots. Snapshots never change, so handing
+  them over is a swap of references under a lock neither side holds for long
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._previous = None
+    self._latest = None
+
+  def publish(self, snapshot):
+    snapshot.published = time.time()
+    with self._lock:
+      self._previous = self._latest
+      self._latest = snapshot
+
+  def latest(self):
+    return self._latest
+
+  def latest_two(self):
+    """ (previous, latest), either of which can be None early on """
+    with self._lock:
+      return self._previous, self._latest
+
+# -----------------------------------------------------------------------------
+#   Update thread
+# -----------------------------------------------------------------------------
+
+class UpdateThread(threading.Thread):
+  def __init__(self, models, update, rate=60.0, max_catch_up=5):
+    """
+    update(dt) is called rate times a second with dt = 1 / rate, and may
+    change models (and the list itself). If it falls more than max_catch_up
+    steps behind, the missed steps are dropped rather than run back to back
+    """
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.models = models
+    self.update = update
+    self.step_time = 1.0 / rate
+    self.max_catch_up = max_catch_up
+    self.snapshots = SnapshotBuffer()
+    self.snapshots.publish(Snapshot.capture(0, 0.0, models))
+
+    self._stopped = threading.Event()
+    self.error = None
+    self.step = 0
+    self.num_dropped_steps = 0
+    # Seconds the slowest and the last update call took
+    self.max_update_seconds = 0.0
+    self.last_update_seconds = 0.0
+
+  def run(self):
+    next_time = time.time()
+    try:
+      while not self._stopped.is_set():
+        now = time.time()
+        if now < next_time:
+          self._stopped.wait(next_time - now)
+          continue
+
+        steps = 0
+        while next_time <= now and steps < self.max_catch_up:
+          start = time.time()
+          self.update(self.step_time)
+          self.last_update_seconds = time.time() - start
+          self.max_update_seconds = max(self.max_update_seconds,
+                                        self.last_update_seconds)
+          self.step += 1
+          steps += 1
+          next_time += self.step_time
+        if next_time <= now:
+          missed = int((now - next_time) / self.step_time) + 1
+          self.num_dropped_steps += missed
+          next_time += missed * self.step_time
+
+        self.snapshots.publish(Snapshot.capture(
+            self.step, self.step * self.step_time, self.models))
+    except Exception, e:
+      # Raised from draw on the render thread
+      self.error = e
+
+  def stop(self):
+    self._stopped.set()
+    self.join()
+
+  # ---------------------------------------------------------------------------
+  #   Rendering side
+  # ---------------------------------------------------------------------------
+
+  def current(self, interpolate=True):
+    """
+    Snapshot to draw now. With interpolate, it is between the last two
+    snapshots, which puts it up to one step behind the simulation but moves
+    smoothly whatever the two rates are
+    """
+    if self.error is not None:
+      raise self.error
+    previous, latest = self.snapshots.latest_two()
+    if not interpolate or previous is None or \
+        not previous.same_models(latest) or latest.time <= previous.time:
+      return latest
+    alpha = (time.time() - latest.published) / (latest.time - previous.time)
+    return previous.interpolate(latest, min(max(alpha, 0.0), 1.0))
+
+  def draw(self, view_matrix, interpolate=True):
+    self.current(interpolate).draw(view_matrix)
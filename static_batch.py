@@ -0,0 +1,163 @@
+"""
+Merges models that never move into a few big meshes
+
+Each model's transform is baked into its vertices, and everything that shares
+a texture and material is merged into one component. The world is split into
+cells of cell_size, one mesh per cell, so whole cells can still be culled
+"""
+from collections import defaultdict
+
+import gl_mode
+from OpenGL.GL import *
+
+import lazy_import
+import mesh
+import vertex_format
+
+numpy = lazy_import.module('numpy')
+
+# -----------------------------------------------------------------------------
+#   Baking
+# -----------------------------------------------------------------------------
+
+def _model_matrix(model):
+  """ Transform matrix of a model as a row-major NumPy array """
+  data = model.get_transform_matrix().data
+  return numpy.array(data, dtype=numpy.float64).reshape(4, 4).T
+
+def _bake(vertices, signature, rotations, translations):
+  """
+  Transforms one component for K instances at once. rotations is (K, 3, 3)
+  and translations (K, 3). Returns an array of shape (K, n, floats_per_vertex)
+  """
+  baked = numpy.repeat(vertices[None, :, :], len(rotations), axis=0)
+  if signature[0]:
+    positions = vertices[:, :3]
+    baked[:, :, :3] = numpy.einsum('kij,nj->kni', rotations, positions) + \
+        translations[:, None, :]
+  if signature[2]:
+    # Normals go through the inverse transpose, which handles scaling
+    col = vertex_format.attribute_column(signature, vertex_format.NORMAL)
+    normal_matrices = numpy.linalg.inv(rotations).transpose(0, 2, 1)
+    normals = numpy.einsum('kij,nj->kni', normal_matrices,
+                           vertices[:, col:col+3])
+    baked[:, :, col:col+3] = vertex_format.normalize_rows(normals)
+  return baked
+
+# -----------------------------------------------------------------------------
+#   Static batch
+# -----------------------------------------------------------------------------
+
+class Cell:
+  def __init__(self, key, mesh, bounds):
+    self.key = key
+    self.mesh = mesh
+    # (min, max) corners in world space
+    self.bounds = bounds
+
+class StaticBatch:
+  def __init__(self, models, cell_size=50.0, **mesh_options):
+    """
+    Reads the geometry of every model's mesh (which needs a CPU copy or a
+    source) and builds the merged meshes. mesh_options are passed on to each
+    cell's mesh.Mesh, e.g. vertex_format or cpu_data
+    """
+    self.cell_size = float(cell_size)
+    self.num_models = len(models)
+    self.cells = []
+    self.num_culled = 0
+    self.num_draw_calls = 0
+
+    # Key is (cell, texture id, material id, signature). Value is
+    # [vertex chunks, index chunks, vertex count, component info]
+    groups = {}
+    cell_bounds = {}
+
+    # All instances of a mesh are transformed in one go
+    models_by_mesh = defaultdict(list)
+    for model in models:
+      models_by_mesh[id(model.mesh)].append(model)
+
+    for instances in models_by_mesh.itervalues():
+      source = instances[0].mesh
+      matrices = numpy.array([_model_matrix(m) for m in instances])
+      rotations = matrices[:, :3, :3]
+      translations = matrices[:, :3, 3]
+
+      for component_index, component in enumerate(source.components):
+        vertices, indices = source.get_geometry(component_index)
+        signature = tuple(component[mesh.Mesh.SIGNATURE])
+        texture = component[mesh.Mesh.TEXTURE]
+        material_id = component.get(mesh.Mesh.MATERIAL_ID)
+        if len(vertices) == 0:
+          continue
+
+        baked = _bake(vertices, signature, rotations, translations)
+        if signature[0]:
+          lo = baked[:, :, :3].min(axis=1)
+          hi = baked[:, :, :3].max(axis=1)
+        else:
+          lo = hi = translations
+        cells = numpy.floor((lo + hi) / (2.0 * self.cell_size)).astype(int)
+
+        for k in xrange(len(instances)):
+          cell = tuple(cells[k])
+          key = (cell, id(texture), material_id, signature)
+          if key not in groups:
+            info = (component[mesh.Mesh.MATERIAL], signature, texture,
+                    material_id)
+            groups[key] = [[], [], 0, info]
+          group = groups[key]
+          group[0].append(baked[k])
+          group[1].append(indices + group[2])
+          group[2] += len(vertices)
+
+          if cell in cell_bounds:
+            old_lo, old_hi = cell_bounds[cell]
+            cell_bounds[cell] = (numpy.minimum(old_lo, lo[k]),
+                                 numpy.maximum(old_hi, hi[k]))
+          else:
+            cell_bounds[cell] = (lo[k], hi[k])
+
+    # One mesh per cell, one component per texture/material
+    cell_meshes = {}
+    for key in sorted(groups.keys()):
+      vertex_chunks, index_chunks, _, info = groups[key]
+      material, signature, texture, material_id = info
+      cell = key[0]
+      if cell not in cell_meshes:
+        cell_meshes[cell] = mesh.Mesh(**mesh_options)
+      cell_meshes[cell].add_component(material,
+                                      numpy.concatenate(vertex_chunks),
+                                      numpy.concatenate(index_chunks),
+                                      list(signature), texture, material_id)
+
+    for cell in sorted(cell_meshes.keys()):
+      lo, hi = cell_bounds[cell]
+      self.cells.append(Cell(cell, cell_meshes[cell],
+                             (lo.tolist(), hi.tolist())))
+
+  def prepare(self):
+    for cell in self.cells:
+      cell.mesh.prepare()
+
+  def draw(self, view_matrix, is_visible=None):
+    """
+    Draws every cell with a single modelview load. is_visible, if given,
+    is called with a cell's (min, max) bounds and can return False to skip it
+    """
+    glMatrixMode(GL_MODELVIEW)
+    view_matrix.load()
+    self.num_culled = 0
+    self.num_draw_calls = 0
+    for cell in self.cells:
+      if is_visible is not None and not is_visible(cell.bounds):
+        self.num_culled += 1
+        continue
+      cell.mesh.draw()
+      self.num_draw_calls += len(cell.mesh.prepared_components)
+
+  def release(self):
+    # Textures still belong to the original meshes
+    for cell in self.cells:
+      cell.mesh.release(textures=False)
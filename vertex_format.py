@@ -0,0 +1,258 @@
+"""
+Compact vertex layouts
+
+Meshes come out of the OBJ reader as float32 position/texcoord/normal. A
+VertexFormat picks a smaller encoding for each attribute, packs vertices into
+an interleaved byte array and reports how much precision was lost
+"""
+import gl_mode
+from OpenGL.GL import *
+
+import lazy_import
+import matrix
+
+numpy = lazy_import.module('numpy')
+
+# -----------------------------------------------------------------------------
+#   Attributes and encodings
+# -----------------------------------------------------------------------------
+
+POSITION = 'position'
+TEXCOORD = 'texcoord'
+NORMAL = 'normal'
+ATTRIBUTES = [POSITION, TEXCOORD, NORMAL]
+
+# Floats per attribute in the uncompressed vertex, same order as a signature
+ATTRIBUTE_SIZES = {
+    POSITION: 3,
+    TEXCOORD: 2,
+    NORMAL: 3,
+  }
+
+FLOAT32 = 'float32'
+FLOAT16 = 'float16'
+# int16 normalized against the range of the data (the AABB for positions)
+SNORM16 = 'snorm16'
+# Signed 10:10:10:2 packed into a single int (normals only)
+PACKED_10_10_10_2 = 'packed_10_10_10_2'
+# Octahedral mapping onto two int16s (normals only). The fixed-function
+# pipeline cannot decode this, so it needs a shader
+OCTAHEDRAL = 'octahedral'
+
+# Bytes used by each encoding, padded so every attribute stays 4-byte aligned
+_ENCODED_BYTES = {
+    POSITION: {FLOAT32: 12, FLOAT16: 8, SNORM16: 8},
+    TEXCOORD: {FLOAT32: 8, FLOAT16: 4, SNORM16: 4},
+    NORMAL: {FLOAT32: 12, PACKED_10_10_10_2: 4, OCTAHEDRAL: 4},
+  }
+
+# GL type that glVertexPointer & co. are given for each encoding
+_GL_TYPES = {
+    FLOAT32: GL_FLOAT,
+    FLOAT16: GL_HALF_FLOAT,
+    SNORM16: GL_SHORT,
+    PACKED_10_10_10_2: GL_INT_2_10_10_10_REV,
+    OCTAHEDRAL: None,
+  }
+
+_SNORM16_MAX = 32767.0
+_SNORM10_MAX = 511.0
+
+# -----------------------------------------------------------------------------
+#   Vertex format
+# -----------------------------------------------------------------------------
+
+class VertexFormat:
+  def __init__(self, position=FLOAT32, texcoord=FLOAT32, normal=FLOAT32):
+    self.encodings = {
+        POSITION: position,
+        TEXCOORD: texcoord,
+        NORMAL: normal,
+      }
+    for attribute, encoding in self.encodings.iteritems():
+      if encoding not in _ENCODED_BYTES[attribute]:
+        raise ValueError('%s cannot be encoded as %s' % (attribute, encoding))
+
+  def __repr__(self):
+    return 'VertexFormat(%s)' % ', '.join(
+        '%s=%s' % (a, self.encodings[a]) for a in ATTRIBUTES)
+
+  def get_encoding(self, attribute):
+    return self.encodings[attribute]
+
+  def get_gl_type(self, attribute):
+    """ Returns None if the fixed-function pipeline cannot read it """
+    return _GL_TYPES[self.encodings[attribute]]
+
+  def layout(self, signature):
+    """
+    Returns (offsets, stride), where offsets is keyed by attribute. Missing
+    attributes take no space
+    """
+    offsets = {}
+    stride = 0
+    for attribute, present in zip(ATTRIBUTES, signature):
+      offsets[attribute] = stride
+      if present:
+        stride += _ENCODED_BYTES[attribute][self.encodings[attribute]]
+    return offsets, stride
+
+  def encode(self, vertices, signature, decode=None):
+    """
+    Packs float vertices of shape (n, floats_per_vertex(signature)) into a
+    uint8 array of shape (n, stride).
+
+    decode holds the ranges the normalized encodings were made against. Pass
+    the one returned by a previous call to encode more vertices the same way
+    (values outside the original range are clamped).
+
+    Returns (data, decode, error), where error is the largest absolute
+    difference per attribute between the input and what the GPU will read
+    """
+    vertices = numpy.asarray(vertices, dtype=numpy.float32)
+    vertices = vertices.reshape(-1, floats_per_vertex(signature))
+    offsets, stride = self.layout(signature)
+    num_vertices = len(vertices)
+    data = numpy.zeros((num_vertices, stride), dtype=numpy.uint8)
+    if decode is None:
+      decode = {}
+    else:
+      decode = dict(decode)
+    error = {}
+
+    column = 0
+    for attribute, present in zip(ATTRIBUTES, signature):
+      if not present:
+        continue
+      size = ATTRIBUTE_SIZES[attribute]
+      values = vertices[:, column:column+size]
+      column += size
+
+      encoding = self.encodings[attribute]
+      if encoding == FLOAT32:
+        encoded, decoded = values, values
+      elif encoding == FLOAT16:
+        encoded = values.astype(numpy.float16)
+        decoded = encoded.astype(numpy.float32)
+      elif encoding == SNORM16:
+        if attribute not in decode:
+          decode[attribute] = _snorm16_range(values)
+        encoded, decoded = _encode_snorm16(values, *decode[attribute])
+      elif encoding == PACKED_10_10_10_2:
+        encoded, decoded = _encode_packed_normals(values)
+      elif encoding == OCTAHEDRAL:
+        encoded, decoded = _encode_octahedral(values)
+
+      # FLOAT32 columns are a slice of vertices, and older NumPy can only
+      # view contiguous arrays as bytes
+      encoded = numpy.ascontiguousarray(encoded)
+      encoded = encoded.view(numpy.uint8).reshape(num_vertices, -1)
+      start = offsets[attribute]
+      data[:, start:start+encoded.shape[1]] = encoded
+      if num_vertices:
+        error[attribute] = float(numpy.abs(decoded - values).max())
+      else:
+        error[attribute] = 0.0
+
+    return data, decode, error
+
+# Uncompressed float32 layout, the same one the OBJ reader produces
+DEFAULT_FORMAT = VertexFormat()
+# About half the size of the default
+COMPACT_FORMAT = VertexFormat(SNORM16, SNORM16, PACKED_10_10_10_2)
+
+def floats_per_vertex(signature):
+  return sum(ATTRIBUTE_SIZES[a] for a, p in zip(ATTRIBUTES, signature) if p)
+
+def attribute_column(signature, attribute):
+  """
+  Index of an attribute's first float in an uncompressed vertex, or None if
+  the signature does not have it
+  """
+  column = 0
+  for a, present in zip(ATTRIBUTES, signature):
+    if a == attribute:
+      return column if present else None
+    if present:
+      column += ATTRIBUTE_SIZES[a]
+
+# -----------------------------------------------------------------------------
+#   Decoding
+# -----------------------------------------------------------------------------
+
+def decode_matrix(offset, scale):
+  """
+  Matrix that turns raw int16 values back into the original range. Position
+  decoding goes on the modelview stack and texcoord decoding on the texture
+  stack, since the fixed-function pipeline does not normalize either
+  """
+  offset = list(offset) + [0.0] * (3 - len(offset))
+  scale = list(scale) + [1.0] * (3 - len(scale))
+  return matrix.multiply(matrix.translate(*offset), matrix.scale(*scale))
+
+# -----------------------------------------------------------------------------
+#   Encoders
+#     Each returns (encoded, decoded), decoded being what the GPU ends up with
+# -----------------------------------------------------------------------------
+
+def _snorm16_range(values):
+  """ Returns (offset, scale) mapping [-32767, 32767] onto the value range """
+  if len(values) == 0:
+    size = values.shape[1]
+    return (0.0,) * size, (1.0,) * size
+  lo = values.min(axis=0).astype(numpy.float64)
+  hi = values.max(axis=0).astype(numpy.float64)
+  center = (lo + hi) / 2.0
+  half_extent = (hi - lo) / 2.0
+  half_extent[half_extent == 0.0] = 1.0
+  return tuple(center), tuple(half_extent / _SNORM16_MAX)
+
+def _encode_snorm16(values, offset, scale):
+  offset = numpy.array(offset, dtype=numpy.float64)
+  scale = numpy.array(scale, dtype=numpy.float64)
+  q = numpy.rint((values - offset) / scale)
+  q = numpy.clip(q, -_SNORM16_MAX, _SNORM16_MAX).astype(numpy.int16)
+  decoded = (q * scale + offset).astype(numpy.float32)
+  if values.shape[1] == 3:
+    # Pad to 8 bytes
+    q = numpy.hstack([q, numpy.zeros((len(q), 1), dtype=numpy.int16)])
+  return numpy.ascontiguousarray(q), decoded
+
+def normalize_rows(values, out=None):
+  """
+  Scales the vectors along the last axis to unit length, leaving zero
+  vectors alone. out may be values itself
+  """
+  lengths = numpy.sqrt((values * values).sum(axis=-1))[..., None]
+  lengths[lengths == 0.0] = 1.0
+  return numpy.divide(values, lengths, out=out)
+
+def _encode_packed_normals(values):
+  n = normalize_rows(values)
+  q = numpy.rint(n * _SNORM10_MAX)
+  q = numpy.clip(q, -_SNORM10_MAX, _SNORM10_MAX).astype(numpy.int32)
+  bits = q & 0x3FF
+  packed = bits[:, 0] | (bits[:, 1] << 10) | (bits[:, 2] << 20)
+  decoded = (q / _SNORM10_MAX).astype(numpy.float32)
+  return numpy.ascontiguousarray(packed.astype(numpy.uint32)), decoded
+
+def _encode_octahedral(values):
+  n = normalize_rows(values)
+  n = n / numpy.maximum(numpy.abs(n).sum(axis=1), 1e-12)[:, None]
+  xy = n[:, :2].copy()
+  lower = n[:, 2] < 0.0
+  signs = numpy.where(xy[lower] >= 0.0, 1.0, -1.0)
+  xy[lower] = (1.0 - numpy.abs(xy[lower][:, ::-1])) * signs
+  q = numpy.rint(xy * _SNORM16_MAX)
+  q = numpy.clip(q, -_SNORM16_MAX, _SNORM16_MAX).astype(numpy.int16)
+  return numpy.ascontiguousarray(q), decode_octahedral(q)
+
+def decode_octahedral(q):
+  """ Inverse of the octahedral encoding, the same math the shader does """
+  xy = q.astype(numpy.float32) / _SNORM16_MAX
+  z = 1.0 - numpy.abs(xy).sum(axis=1)
+  lower = z < 0.0
+  signs = numpy.where(xy[lower] >= 0.0, 1.0, -1.0)
+  xy[lower] = (1.0 - numpy.abs(xy[lower][:, ::-1])) * signs
+  n = numpy.hstack([xy, z[:, None]])
+  return normalize_rows(n).astype(numpy.float32)
@@ -7,10 +7,12 @@ import sys
 import time
 from collections import defaultdict
 
+import gl_mode
 from OpenGL.GLUT import *
-from OpenGL.GLU import *
 from OpenGL.GL import *
 
+import resources
+
 # -----------------------------------------------------------------------------
 #   Config and global state
 #     Stored here so we only have to include window to get started and not
@@ -29,6 +31,8 @@ DEFAULT_FPS = 30
 # Cannot store this in a class for some reason
 _main_loop_callback = None
 _resize_window_callback = None
+# capture.FrameCapture recording every frame, if any
+_capture = None
 
 class _WindowState:
   """ Stores global state about the window and setup """
@@ -105,12 +109,18 @@ def _main_loop():
   if fcn is not None:
     fcn(time_elapsed)
 
-  # Error handling and frame cleanup
-  error = glGetError()
-  if error:
-    print gluErrorString(error)
+  # Error handling and frame cleanup. glGetError waits for the GPU, so
+  # production skips it
+  if not gl_mode.is_production():
+    error = glGetError()
+    if error:
+      from OpenGL.GLU import gluErrorString
+      print gluErrorString(error)
 
+  if _capture is not None:
+    _capture.capture()
   glutSwapBuffers()
+  resources.manager.next_frame()
 
 # -----------------------------------------------------------------------------
 #   Keyboard/Mouse functions
@@ -269,3 +279,9 @@ def set_resize_callback(fcn):
   global _resize_window_callback
   _resize_window_callback = fcn
 
+""" Recording """
+def set_capture(capture):
+  """ capture is a capture.FrameCapture, or None to stop recording """
+  global _capture
+  _capture = capture
+